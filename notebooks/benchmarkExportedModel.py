@@ -0,0 +1,50 @@
+# %%
+# Check that the exported segmentation model matches DefaultPredictor and compare images/s on the CPU
+from src.models import modelTools
+from src.models.exportModel import exportSegmentModel, exportedPredictor, checkExportParity, benchmarkPredictors
+from src.data.segmentSingleCell import readImagePair
+
+import os
+import torch
+import numpy as np
+from skimage.draw import disk
+# %%
+experiment = 'TJ2201'
+modelPath = '../models/segmentation/TJ2201Split16'
+dataPath = os.path.join('../data', experiment, 'split16')
+
+if not os.path.isfile(os.path.join(modelPath, 'model_final.pth')):
+    # Without a trained model, time a randomly initialized one saved the same way.
+    # Classifier weights are spread out so some detections pass the threshold and reach the mask head
+    from detectron2.modeling import build_model
+    from detectron2.checkpoint import DetectionCheckpointer
+    modelPath = '../models/segmentation/randomInit'
+    os.makedirs(modelPath, exist_ok=True)
+    torch.manual_seed(1234)
+    model = build_model(modelTools.getSegmentConfig(modelPath))
+    torch.nn.init.normal_(model.roi_heads.box_predictor.cls_score.weight, std=1.0)
+    DetectionCheckpointer(model, save_dir=modelPath).save('model_final')
+
+if os.path.isdir(os.path.join(dataPath, 'phaseContrast')):
+    pcIms = sorted(os.listdir(os.path.join(dataPath, 'phaseContrast')))[0:20]
+    imgBases = [pcIm.split('phaseContrast_')[1].split('.png')[0] for pcIm in pcIms]
+    pcImgs = [readImagePair(dataPath, imgBase)[1] for imgBase in imgBases]
+else:
+    # Without data, use split16 sized frames of bright cells on a noisy background
+    rng = np.random.default_rng(1234)
+    pcImgs = []
+    for n in range(20):
+        img = rng.integers(90, 130, (260, 352)).astype('uint8')
+        for cell in range(40):
+            rr, cc = disk(rng.integers(0, 260, 2), rng.integers(5, 15), shape=img.shape)
+            img[rr, cc] = rng.integers(160, 220)
+        pcImgs.append(np.array([img, img, img]).transpose([1, 2, 0]))
+# %% Export once
+exportSegmentModel(modelPath, pcImgs[0], 'torchscript')
+# %%
+predictor = modelTools.getSegmentModel(modelPath)
+exported = exportedPredictor(modelPath)
+print(f'Parity: {checkExportParity(predictor, exported, pcImgs)}')
+# %%
+print(f'Using {torch.get_num_threads()} threads')
+benchmarkPredictors({'DefaultPredictor': predictor, 'TorchScript': exported}, pcImgs)
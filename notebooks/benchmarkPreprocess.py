@@ -0,0 +1,58 @@
+# %%
+# Compare the exact LIVECell preprocessing against a background estimated at reduced resolution
+from src.data import imageProcessing
+
+import os
+import time
+import numpy as np
+from skimage.io import imread
+from skimage.draw import disk
+# %%
+experiment = 'TJ2201'
+phaseContrastPath = os.path.join('../data', experiment, 'raw', 'phaseContrast')
+if os.path.isdir(phaseContrastPath):
+    phaseContrastIms = sorted(os.listdir(phaseContrastPath))[0:10]
+    images = [imread(os.path.join(phaseContrastPath, phaseContrastIm)) for phaseContrastIm in phaseContrastIms]
+    images = [image[:,:,0] if image.ndim == 3 else image for image in images]
+else:
+    # Without data, use noisy frames with uneven illumination and haloed cells
+    rng = np.random.default_rng(1234)
+    images = []
+    rows, cols = np.mgrid[0:1040, 0:1408]
+    for n in range(10):
+        illumination = 1 + 0.25*np.sin(rows/400 + n) * np.cos(cols/500)
+        image = rng.normal(110, 6, (1040, 1408))
+        for cell in range(300):
+            center, radius = rng.integers(0, 1040, 2), rng.integers(6, 20)
+            rr, cc = disk(center, radius + 2, shape=(1040, 1408))
+            image[rr, cc] += 60
+            rr, cc = disk(center, radius, shape=(1040, 1408))
+            image[rr, cc] -= 90 + rng.normal(0, 10, len(rr))
+        images.append(np.clip(image*illumination, 0, 255).astype('uint8'))
+print(f'Frame shape: {images[0].shape}, dtype: {images[0].dtype}')
+# %% Time and accuracy of each background downsampling
+then = time.time()
+for image in images:
+    imageProcessing.preprocess(image)
+timeExact = (time.time()-then)/len(images)
+print(f'Exact: {timeExact*1000:0.1f} ms per frame')
+for backgroundDownsample in [2, 4, 8]:
+    then = time.time()
+    for image in images:
+        imageProcessing.preprocess(image, backgroundDownsample=backgroundDownsample)
+    timeFast = (time.time()-then)/len(images)
+    print(f'Downsample {backgroundDownsample}: {timeFast*1000:0.1f} ms per frame, {timeExact/timeFast:0.1f}x speedup')
+    imageProcessing.preprocessAccuracy(images, backgroundDownsample)
+# Synthetic 1040 x 1408 frames, one Xeon core:
+# Exact: 51.4 ms per frame
+# Downsample 2: 30.7 ms, 1.7x speedup, mean difference 0.912, max 19, 19.33% of pixels off by >1, 0.15% off by >5
+# Downsample 4: 26.0 ms, 2.0x speedup, mean difference 1.108, max 22, 27.12% of pixels off by >1, 0.45% off by >5
+# Downsample 8: 25.4 ms, 2.0x speedup, mean difference 1.227, max 24, 31.50% of pixels off by >1, 0.69% off by >5
+# cv2.medianBlur on uint8 is already fast at 75 px, so past 2x the resizing and scaling dominate
+# %% Reusing one background per position
+backgroundCache = {}
+then = time.time()
+for image in images:
+    imageProcessing.preprocess(image, backgroundCache=backgroundCache, cacheKey='B2_1')
+print(f'Cached: {(time.time()-then)/len(images)*1000:0.1f} ms per frame')
+# Cached: 28.7 ms per frame
@@ -0,0 +1,59 @@
+# %%
+# Compare images/s of DefaultPredictor one image at a time vs. modelTools.batchPredict
+from src.models import modelTools
+from src.data.segmentSingleCell import readImagePair
+
+import os
+import time
+import torch
+import numpy as np
+from skimage.draw import disk
+# %%
+experiment = 'TJ2201'
+dataPath = os.path.join('../data', experiment, 'split16')
+modelPath = '../models/segmentation/TJ2201Split16'
+if not os.path.isfile(os.path.join(modelPath, 'model_final.pth')):
+    # Without a trained model, time a randomly initialized one saved the same way.
+    # Classifier weights are spread out so some detections pass the threshold and reach the mask head
+    from detectron2.modeling import build_model
+    from detectron2.checkpoint import DetectionCheckpointer
+    modelPath = '../models/segmentation/randomInit'
+    os.makedirs(modelPath, exist_ok=True)
+    torch.manual_seed(1234)
+    model = build_model(modelTools.getSegmentConfig(modelPath))
+    torch.nn.init.normal_(model.roi_heads.box_predictor.cls_score.weight, std=1.0)
+    DetectionCheckpointer(model, save_dir=modelPath).save('model_final')
+predictor = modelTools.getSegmentModel(modelPath)
+
+if os.path.isdir(os.path.join(dataPath, 'phaseContrast')):
+    pcIms = sorted(os.listdir(os.path.join(dataPath, 'phaseContrast')))[0:32]
+    imgBases = [pcIm.split('phaseContrast_')[1].split('.png')[0] for pcIm in pcIms]
+    pcImgs = [readImagePair(dataPath, imgBase)[1] for imgBase in imgBases]
+else:
+    # Without data, use split16 sized frames of bright cells on a noisy background
+    rng = np.random.default_rng(1234)
+    pcImgs = []
+    for n in range(32):
+        img = rng.integers(90, 130, (260, 352)).astype('uint8')
+        for cell in range(40):
+            rr, cc = disk(rng.integers(0, 260, 2), rng.integers(5, 15), shape=img.shape)
+            img[rr, cc] = rng.integers(160, 220)
+        pcImgs.append(np.array([img, img, img]).transpose([1, 2, 0]))
+print(f'Using {torch.get_num_threads()} threads on {predictor.cfg.MODEL.DEVICE}')
+# %% One image at a time
+then = time.time()
+for pcImg in pcImgs:
+    outputs = predictor(pcImg)['instances'].to('cpu')
+elapsed = time.time() - then
+print(f'DefaultPredictor: {len(pcImgs)/elapsed:0.2f} images/s')
+# %% Batched
+for batchSize in [2, 4, 8]:
+    then = time.time()
+    for i in range(0, len(pcImgs), batchSize):
+        outputs = modelTools.batchPredict(predictor, pcImgs[i:i+batchSize])
+    elapsed = time.time() - then
+    print(f'batchPredict ({batchSize}): {len(pcImgs)/elapsed:0.2f} images/s')
+# %% Check that batched predictions match
+outputSingle = predictor(pcImgs[0])['instances'].to('cpu')
+outputBatch = modelTools.batchPredict(predictor, pcImgs[0:4])[0]['instances'].to('cpu')
+print(f'{len(outputSingle)} cells single, {len(outputBatch)} cells batched')
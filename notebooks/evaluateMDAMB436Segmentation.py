@@ -298,4 +298,15 @@ for annotation in record['annotations']:
     polygonSki = list(zip(polyy, polyx))
     plt.plot(polyx, polyy, linewidth = 1)
 plt.imshow(imgComposite)
-# %%
\ No newline at end of file
+# %% Threshold sweep
+# Segment once with a low threshold, e.g. segmentExperiment with
+# modelTools.getSegmentModel('../models/segmentation/mdamb436Seg', confidenceThresh = 0.05),
+# then filter the saved records instead of predicting again for every threshold
+from src.data.segmentSingleCell import getAnnotationScores, filterDatasetDict
+
+datasetDictsLow = list(np.load(f'../data/{experiment}/{experiment}DatasetDict.npy', allow_pickle=True))
+scores = getAnnotationScores(datasetDictsLow)
+for scoreThresh in [0.3, 0.5, 0.7, 0.9]:
+    datasetDictsThresh = filterDatasetDict(datasetDictsLow, scoreThresh, scores)
+    nCells = sum([len(record['annotations']) for record in datasetDictsThresh])
+    print(f'{scoreThresh}: {nCells} cells')
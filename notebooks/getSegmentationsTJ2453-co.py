@@ -1,6 +1,6 @@
 # %%
 from src.visualization.segmentationVis import  viewPredictorResult
-from src.data.imageProcessing import imSplit, findFluorescenceColor, removeImageAbberation
+from src.data.imageProcessing import imSplit, findFluorescenceColor, findFluorescenceColors, removeImageAbberation
 from src.models import modelTools
 
 from detectron2.data.datasets import register_coco_instances
@@ -37,11 +37,13 @@ def getRecord(pcName, compositeImg, pcImg, idx, predictor):
 
     outputs = predictor(pcImg)['instances'].to("cpu")  # format is documented at https://detectron2.readthedocs.io/tutorials/models.html#model-output-format
     nCells = len(outputs)
+    masks = outputs.pred_masks.numpy()
+    colors = findFluorescenceColors(compositeImg, masks)
     cells = []
     # Get segmentation outlines
     for cellNum in range(nCells):
-        mask = outputs[cellNum].pred_masks.numpy()[0]
-        color = findFluorescenceColor(compositeImg, mask)
+        mask = masks[cellNum]
+        color = colors[cellNum]
         if color == 'green':
             pheno = 1
         elif color == 'red':
@@ -11,13 +11,21 @@ import detectron2.data.datasets as datasets
 import detectron2
 from detectron2.structures import BoxMode
 from detectron2.data import MetadataCatalog, DatasetCatalog
+
+from src.data.imageProcessing import rleTouchesBorder
 # %%
-datasetDicts = datasets.load_coco_json(json_file='../../data/TJ2301-231C2/TJ2301-231C2Segmentations.json', image_root='')
-datasetDicts = [record for record in datasetDicts if len(record['annotations']) > 0]
-for record in tqdm(datasetDicts):
-    for cell in record['annotations']:
-        cell['bbox'] = detectron2.structures.BoxMode.convert(cell['bbox'], from_mode = BoxMode.XYWH_ABS, to_mode = BoxMode.XYXY_ABS)
-        cell['bbox_mode'] = BoxMode.XYXY_ABS
+# Datasets from segmentExperiment(saveRLE=True) keep annotation['maskRLE'], COCO json files do not
+datasetDictPath = '../../data/TJ2301-231C2/TJ2301-231C2Segmentations.json'
+if datasetDictPath.endswith('.npy'):
+    datasetDicts = list(np.load(datasetDictPath, allow_pickle=True))
+    datasetDicts = [record for record in datasetDicts if len(record['annotations']) > 0]
+else:
+    datasetDicts = datasets.load_coco_json(json_file=datasetDictPath, image_root='')
+    datasetDicts = [record for record in datasetDicts if len(record['annotations']) > 0]
+    for record in tqdm(datasetDicts):
+        for cell in record['annotations']:
+            cell['bbox'] = detectron2.structures.BoxMode.convert(cell['bbox'], from_mode = BoxMode.XYWH_ABS, to_mode = BoxMode.XYXY_ABS)
+            cell['bbox_mode'] = BoxMode.XYXY_ABS
 # %%
 breakOn = 0
 ddNoBorder = []
@@ -25,6 +33,11 @@ for seg in tqdm(datasetDicts):
     segNoBorder = seg.copy()
     segNoBorder['annotations'] = []
     for i, annotation in enumerate(seg['annotations']):
+        # Run length encoded masks only need their bounding box decoded
+        if 'maskRLE' in annotation.keys():
+            if not rleTouchesBorder(annotation['maskRLE'], [seg['height'], seg['width']]):
+                segNoBorder['annotations'].append(annotation)
+            continue
         mask = np.zeros([seg['height'], seg['width']])
         polyx = annotation['segmentation'][0][::2]
         polyy = annotation['segmentation'][0][1::2]
@@ -0,0 +1,245 @@
+"""
+Tools for saving single cell crops once so that they can be reused by every training run
+"""
+from src.data.imageProcessing import bbIncrease, letterboxCrop, bbIncreaseWindows
+from src.data.fileManagement import splitName2Whole
+
+import os
+import json
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+
+from skimage.io import imread
+
+def enumerateAnnotations(datasetDicts):
+    """
+    Flattens every annotation of a datasetDict in order. The position of an annotation
+    in this order is its row in the crop store.
+
+    Inputs:
+        - datasetDicts: Segmentations in detectron2 format
+    Outputs:
+        - index: Dictionary of numpy arrays for each annotation
+            - imgNames: Name of the split image the cell was found in
+            - wells: Well of the image
+            - labels: Encoded phenotype
+            - bbs: Bounding box in split image coordinates
+        - polys: List of nx2 polygons for each annotation
+    """
+    imgNames, wells, labels, bbs, polys = [], [], [], [], []
+    for record in datasetDicts:
+        imgName = os.path.basename(record['file_name'])
+        well = imgName.split('_')[1]
+        for annotation in record['annotations']:
+            seg = np.array(annotation['segmentation'][0])
+            polys.append(np.reshape(seg, (int(len(seg)/2), 2)))
+            labels.append(annotation['category_id'])
+            imgNames.append(imgName)
+            wells.append(well)
+            bbs.append([int(corner) for corner in annotation['bbox']])
+
+    index = {
+        'imgNames': np.array(imgNames, dtype='str'),
+        'wells': np.array(wells, dtype='str'),
+        'labels': np.array(labels, dtype='int16'),
+        'bbs': np.array(bbs, dtype='int32').reshape(-1, 4),
+    }
+    return index, polys
+
+def buildCropStore(datasetDicts, dataPath, storePath, nIncrease, maxImgSize, nIms, augmentation = 'None'):
+    """
+    Crops every annotation in a datasetDict once and saves the letterboxed crops
+    as a single memory-mapped array.
+
+    Inputs:
+        - datasetDicts: Segmentations in detectron2 format
+        - dataPath: Location of whole images
+        - storePath: Directory to save crops.npy and index.npz
+        - nIncrease: Amount to increase bounding box around cell
+        - maxImgSize: Final size of each crop
+        - nIms: Number of images the whole image was split into
+        - augmentation: Augmentation passed to bbIncrease
+    Outputs:
+        - crops: Memory-mapped uint8 array of shape N x maxImgSize x maxImgSize
+    """
+    storePath = Path(storePath)
+    storePath.mkdir(parents=True, exist_ok=True)
+
+    index, polys = enumerateAnnotations(datasetDicts)
+    nCells = len(polys)
+    crops = np.lib.format.open_memmap(storePath / 'crops.npy', mode='w+', dtype='uint8', shape=(nCells, maxImgSize, maxImgSize))
+
+    # Visit cells one whole image at a time so each image is only decoded once
+    imgNamesWhole = np.array([splitName2Whole(imgName) for imgName in index['imgNames']])
+    order = np.argsort(imgNamesWhole, kind='stable')
+    currentName, img = None, None
+    for row in tqdm(order):
+        imgName = index['imgNames'][row]
+        if imgNamesWhole[row] != currentName:
+            currentName = imgNamesWhole[row]
+            img = imread(os.path.join(dataPath, currentName))
+        imgCrop = bbIncrease(polys[row], index['bbs'][row], imgName, img, nIms, nIncrease, augmentation=augmentation)
+        crops[row] = np.uint8(letterboxCrop(imgCrop, maxImgSize)*255)
+    crops.flush()
+
+    params = {'kind': 'letterbox', 'nIncrease': nIncrease, 'maxImgSize': maxImgSize, 'nIms': nIms, 'augmentation': str(augmentation)}
+    np.savez(storePath / 'index.npz', params = json.dumps(params), **index)
+    return crops
+
+def loadCropStoreIndex(storePath):
+    """
+    Loads the index of a crop store or crop pyramid
+
+    Inputs:
+        - storePath: Directory holding index.npz
+    Outputs:
+        - index: Dictionary of annotation information and build parameters
+    """
+    with np.load(Path(storePath) / 'index.npz') as indexFile:
+        index = {key: indexFile[key] for key in indexFile.files}
+    index['params'] = json.loads(str(index['params']))
+    # Stores built before pyramids were added are all letterboxed
+    if 'kind' not in index['params'].keys():
+        index['params']['kind'] = 'letterbox'
+    return index
+
+def loadCropStore(storePath):
+    """
+    Loads a crop store made with buildCropStore
+
+    Inputs:
+        - storePath: Directory holding crops.npy and index.npz
+    Outputs:
+        - crops: Read-only memory-mapped crops
+        - index: Dictionary of annotation information and build parameters
+    """
+    storePath = Path(storePath)
+    crops = np.load(storePath / 'crops.npy', mmap_mode='r')
+    index = loadCropStoreIndex(storePath)
+    return crops, index
+
+def buildCropPyramid(datasetDicts, dataPath, storePath, nIncreaseMax, nIms, padNum = 200):
+    """
+    Crops every annotation once at the largest bounding box increase of a sweep. Any
+    smaller nIncrease and any bbIncrease augmentation can then be rebuilt from the stored
+    crop with pyramidCrop, without reading whole images again.
+
+    Crops have different sizes, so they are appended to flat files and found with the
+    starts and shapes saved in the index. Alongside each crop a mask is saved where
+    bit 0 is the filled polygon and bit 1 is the polygon perimeter.
+
+    Inputs:
+        - datasetDicts: Segmentations in detectron2 format
+        - dataPath: Location of whole images
+        - storePath: Directory to save crops.bin, masks.bin, and index.npz
+        - nIncreaseMax: Largest amount to increase bounding box around cell
+        - nIms: Number of images the whole image was split into
+        - padNum: The padding on the whole image used by bbIncrease
+    Outputs:
+        - index: Dictionary of annotation information and build parameters
+    """
+    storePath = Path(storePath)
+    storePath.mkdir(parents=True, exist_ok=True)
+
+    index, polys = enumerateAnnotations(datasetDicts)
+    nCells = len(polys)
+    starts = np.zeros(nCells, dtype='int64')
+    shapes = np.zeros((nCells, 2), dtype='int32')
+    windows = np.zeros((nCells, 4), dtype='int64')
+    origins = np.zeros((nCells, 2), dtype='int64')
+    paddedShapes = np.zeros((nCells, 2), dtype='int64')
+
+    imgNamesWhole = np.array([splitName2Whole(imgName) for imgName in index['imgNames']])
+    order = np.argsort(imgNamesWhole, kind='stable')
+    currentName, img = None, None
+    nBytes = 0
+    with open(storePath / 'crops.bin', 'wb') as cropFile, open(storePath / 'masks.bin', 'wb') as maskFile:
+        for row in tqdm(order):
+            imgName = index['imgNames'][row]
+            if imgNamesWhole[row] != currentName:
+                currentName = imgNamesWhole[row]
+                img = imread(os.path.join(dataPath, currentName))
+                assert img.ndim == 2, 'Crop pyramids require grayscale whole images'
+            poly, bb = polys[row], index['bbs'][row]
+            crop = bbIncrease(poly, bb, imgName, img, nIms, nIncreaseMax, padNum, augmentation='None')
+            fill = bbIncrease(poly, bb, imgName, img, nIms, nIncreaseMax, padNum, augmentation='shape')
+            perimeter = bbIncrease(poly, bb, imgName, img, nIms, nIncreaseMax, padNum, augmentation='outline')
+            maskBits = fill.astype('uint8') | ((perimeter > 0).astype('uint8') << 1)
+
+            window = bbIncreaseWindows([bb], [imgName], img.shape, nIms, nIncreaseMax, padNum)[0]
+            paddedShape = (img.shape[0] + 2*padNum, img.shape[1] + 2*padNum)
+            windows[row] = window
+            paddedShapes[row] = paddedShape
+            origins[row] = [slice(int(window[0]), int(window[1])).indices(paddedShape[0])[0],
+                            slice(int(window[2]), int(window[3])).indices(paddedShape[1])[0]]
+            starts[row] = nBytes
+            shapes[row] = crop.shape
+            cropFile.write(np.ascontiguousarray(crop, dtype='uint8').tobytes())
+            maskFile.write(np.ascontiguousarray(maskBits).tobytes())
+            nBytes += crop.size
+
+    params = {'kind': 'pyramid', 'nIncreaseMax': nIncreaseMax, 'nIms': nIms, 'padNum': padNum}
+    pyramidIndex = {'starts': starts, 'shapes': shapes, 'windows': windows, 'origins': origins, 'paddedShapes': paddedShapes}
+    np.savez(storePath / 'index.npz', params = json.dumps(params), **index, **pyramidIndex)
+    return loadCropStoreIndex(storePath)
+
+def loadCropPyramid(storePath):
+    """
+    Loads a crop pyramid made with buildCropPyramid
+
+    Inputs:
+        - storePath: Directory holding crops.bin, masks.bin, and index.npz
+    Outputs:
+        - crops: Read-only memory-mapped flat crops
+        - masks: Read-only memory-mapped flat polygon masks
+        - index: Dictionary of annotation information and build parameters
+    """
+    storePath = Path(storePath)
+    crops = np.memmap(storePath / 'crops.bin', dtype='uint8', mode='r')
+    masks = np.memmap(storePath / 'masks.bin', dtype='uint8', mode='r')
+    index = loadCropStoreIndex(storePath)
+    return crops, masks, index
+
+def pyramidCrop(crops, masks, index, row, nIncrease, augmentation = 'None'):
+    """
+    Rebuilds the output of bbIncrease for a smaller nIncrease from a crop pyramid.
+    The smaller window is the center of the stored crop, following the same clipping
+    as the padded whole image, so the result is pixel-identical to bbIncrease.
+
+    Inputs:
+        - crops, masks, index: Crop pyramid from loadCropPyramid
+        - row: Position of the cell among all annotations of datasetDicts
+        - nIncrease: Amount to increase bounding box around cell
+        - augmentation: Augmentation as in bbIncrease
+    Outputs:
+        - imgCrop: Crop of the cell
+    """
+    nIncreaseMax = index['params']['nIncreaseMax']
+    if nIncrease > nIncreaseMax:
+        raise ValueError(f'nIncrease of {nIncrease} is larger than the stored {nIncreaseMax}')
+    start = int(index['starts'][row])
+    nRows, nCols = [int(dim) for dim in index['shapes'][row]]
+    crop = np.asarray(crops[start:start + nRows*nCols]).reshape(nRows, nCols)
+    maskBits = np.asarray(masks[start:start + nRows*nCols]).reshape(nRows, nCols)
+
+    shrink = nIncreaseMax - nIncrease
+    rowMin, rowMax, colMin, colMax = [int(corner) for corner in index['windows'][row]]
+    paddedRows, paddedCols = [int(dim) for dim in index['paddedShapes'][row]]
+    rowOrigin, colOrigin = [int(origin) for origin in index['origins'][row]]
+    rowStart, rowStop, _ = slice(rowMin + shrink, rowMax - shrink).indices(paddedRows)
+    colStart, colStop, _ = slice(colMin + shrink, colMax - shrink).indices(paddedCols)
+    subWindow = (slice(rowStart - rowOrigin, max(rowStop, rowStart) - rowOrigin),
+                 slice(colStart - colOrigin, max(colStop, colStart) - colOrigin))
+    imgCrop = crop[subWindow].copy()
+    fill = (maskBits[subWindow] & 1).astype('bool')
+
+    if augmentation == 'blackoutCell':
+        imgCrop[fill] = 255
+    if augmentation == 'outline':
+        imgCrop = ((maskBits[subWindow] & 2) > 0).astype('float')
+    if augmentation == 'stamp':
+        imgCrop[~fill] = 0
+    if augmentation == 'shape':
+        imgCrop = fill
+    return imgCrop
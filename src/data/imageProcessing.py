@@ -1,21 +1,35 @@
+import os
+import inspect
+import hashlib
+import tempfile
 import numpy as np
 import itertools
+from pathlib import Path
 from scipy.interpolate import interp1d
+from scipy import ndimage as ndi
 
 from skimage.color import rgb2hsv
 from skimage import morphology, measure
 from skimage.segmentation import clear_border
-from skimage.draw import polygon2mask, polygon_perimeter
+from skimage.draw import polygon2mask, polygon_perimeter, polygon
+from skimage.transform import resize
+from skimage.util import img_as_float
 import cv2
-# import pyfeats
 
 # %% General tools
 def dilN(im, n = 1):
-    """Dilates image n number of times"""
-    for i in range(n):
-        im = morphology.binary_dilation(im)
-    return im
-def removeImageAbberation(RGB, thresh = 10000):
+    """
+    Dilates image n number of times. Each binary_dilation grows by one pixel with a
+    cross footprint, so n dilations are every pixel within taxicab distance n, which
+    is found with a single distance transform.
+    """
+    im = np.asarray(im).astype('bool')
+    if n < 1 or not im.any():
+        return im.copy()
+    distance = ndi.distance_transform_cdt(~im, metric='taxicab')
+    return distance <= n
+
+def removeImageAbberation(RGB, thresh = 10000, nDilate = 50):
     """
     Block out very large areas where there are green spots in 
     fluorescence images. 
@@ -23,33 +37,44 @@ def removeImageAbberation(RGB, thresh = 10000):
     Inputs: 
         - RGB: RGB image
         - thresh: Number of pixels required to intervene
+        - nDilate: Number of dilations around the convex hull of the aberration
 
     Outputs:
         - RGBNew: RGB image with aberration blocked out to median values
     """
     # Get BW image of very bright green objects
     nGreen, BW = segmentGreenHigh(RGB)
+    # A dilation at most grows each pixel to 5 pixels, so no blob can pass thresh
+    if 5*nGreen <= thresh:
+        return RGB, 0
     # Do a bit of processing to get an idea of where a cell might be
     # and where an abberation might be
     BW = morphology.remove_small_objects(BW)
     dil = morphology.binary_dilation(BW)
     # Find and remove blobs
     labels = measure.label(dil)
-    unique, cts = np.unique(labels, return_counts=True)
-    unique = unique[1:]
-    cts = cts[1:]
+    cts = np.bincount(labels.ravel())
     # Only take away very large aberrations, otherwise there's no solution likely
-    numsHigh = unique[cts>thresh]
+    numsHigh = np.flatnonzero(cts[1:] > thresh) + 1
     if len(numsHigh) == 0:
         return RGB, 0
-    isAbberation = np.isin(labels, numsHigh)
+    isHigh = np.zeros(len(cts), dtype='bool')
+    isHigh[numsHigh] = True
+    isAbberation = isHigh[labels]
+
+    # Only work within the aberration's bounding box grown by the dilation
+    rows = np.flatnonzero(np.any(isAbberation, axis=1))
+    cols = np.flatnonzero(np.any(isAbberation, axis=0))
+    rowMin, rowMax = max(rows[0] - nDilate, 0), min(rows[-1] + nDilate + 1, RGB.shape[0])
+    colMin, colMax = max(cols[0] - nDilate, 0), min(cols[-1] + nDilate + 1, RGB.shape[1])
     # Use convex hull to fully enclose cells
-    convexAbberation = morphology.convex_hull_image(isAbberation)
-    convexAbberation = dilN(convexAbberation, 50)
+    convexAbberation = morphology.convex_hull_image(isAbberation[rowMin:rowMax, colMin:colMax])
+    convexAbberation = dilN(convexAbberation, nDilate)
 
     RGBNew = RGB.copy()
-    RGBNew[convexAbberation, 1] = np.median(RGBNew[:,:,1])
-    RGBNew[convexAbberation, 2] = np.median(RGBNew[:,:,2])
+    RGBWindow = RGBNew[rowMin:rowMax, colMin:colMax]
+    RGBWindow[convexAbberation, 1] = np.median(RGBNew[:,:,1])
+    RGBWindow[convexAbberation, 2] = np.median(RGBNew[:,:,2])
     
     return RGBNew, 1
 
@@ -89,13 +114,10 @@ def clearEdgeCells(cell):
     else:
         return 1
 
-def segmentGreen(RGB):
+def thresholdGreen(RGB):
     """
-    Finds green pixels from Incucyte data
-    Input: RGB image
-    Output: # of green pixels and mask of green pixels
+    Thresholds green pixels in HSV space, see segmentGreen
     """
-    # def segment
     I = rgb2hsv(RGB)
 
     # Define thresholds for channel 1 based on histogram settings
@@ -114,25 +136,13 @@ def segmentGreen(RGB):
     sliderBW =  np.array(I[:,:,0] >= channel1Min ) & np.array(I[:,:,0] <= channel1Max) & \
                 np.array(I[:,:,1] >= channel2Min ) & np.array(I[:,:,1] <= channel2Max) & \
                 np.array(I[:,:,2] >= channel3Min ) & np.array(I[:,:,2] <= channel3Max)
-    BW = sliderBW
+    return sliderBW
 
-    # Initialize output masked image based on input image.
-    maskedRGBImage = RGB.copy()
-
-    # Set background pixels where BW is false to zero.
-    maskedRGBImage[~np.dstack((BW, BW, BW))] = 0
-
-    nGreen = np.sum(BW)
-    return nGreen, BW
-
-def segmentGreenHigh(RGB):
+def thresholdGreenHigh(RGB):
     """
-    Finds very bright green pixels from Incucyte data
-    Input: RGB image
-    Output: # of green pixels and mask of green pixels
+    Thresholds very bright green pixels in RGB space, see segmentGreenHigh
     """
-    # def segment
-    I = RGB.copy()
+    I = RGB
 
     # Define thresholds for channel 1 based on histogram settings
     channel1Min = 0.000;
@@ -150,22 +160,11 @@ def segmentGreenHigh(RGB):
     sliderBW =  np.array(I[:,:,0] >= channel1Min ) & np.array(I[:,:,0] <= channel1Max) & \
                 np.array(I[:,:,1] >= channel2Min ) & np.array(I[:,:,1] <= channel2Max) & \
                 np.array(I[:,:,2] >= channel3Min ) & np.array(I[:,:,2] <= channel3Max)
-    BW = sliderBW
-
-    # Initialize output masked image based on input image.
-    maskedRGBImage = RGB.copy()
-
-    # Set background pixels where BW is false to zero.
-    maskedRGBImage[~np.dstack((BW, BW, BW))] = 0
-
-    nGreen = np.sum(BW)
-    return nGreen, BW
+    return sliderBW
 
-def segmentRed(RGB):
+def thresholdRed(RGB):
     """
-    Finds red pixels from Incucyte data
-    Input: RGB image
-    Output: # of red pixels and mask of green pixels
+    Thresholds red pixels in HSV space, see segmentRed
     """
     # Convert RGB image to chosen color space
     I = rgb2hsv(RGB)
@@ -186,18 +185,255 @@ def segmentRed(RGB):
     sliderBW =  np.array(I[:,:,0] >= channel1Min )  | np.array(I[:,:,0] <= channel1Max)  & \
                 np.array(I[:,:,1] >= channel2Min ) &  np.array(I[:,:,1] <= channel2Max) & \
                 np.array(I[:,:,2] >= channel3Min ) &  np.array(I[:,:,2] <= channel3Max)
-    BW = sliderBW
+    return sliderBW
 
-    # Initialize output masked image based on input image.
-    maskedRGBImage = RGB.copy()
+colorThresholds = {'green': thresholdGreen, 'greenHigh': thresholdGreenHigh, 'red': thresholdRed}
+colorLUTs = {}
+colorLUTPath = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'cellMorph' / 'colorLUTs'
 
-    # Set background pixels where BW is false to zero.
+def getColorLUT(color: str):
+    """
+    Gets a bit-packed lookup table of the threshold for every 8-bit RGB value. Tables
+    are built the first time they are needed by running the threshold function over
+    all 256**3 colors and are then saved in colorLUTPath (~/.cache/cellMorph/colorLUTs).
+    File names include a hash of the threshold function's source, so editing a threshold
+    builds a new table.
 
-    maskedRGBImage[~np.dstack((BW, BW, BW))] = 0
+    Inputs:
+        - color: Key of colorThresholds
+    Outputs:
+        - lut: uint8 array of 2**21 bytes, bit (R << 16 | G << 8 | B) is the threshold result
+    """
+    if color in colorLUTs.keys():
+        return colorLUTs[color]
+    sourceHash = hashlib.md5(inspect.getsource(colorThresholds[color]).encode()).hexdigest()[0:8]
+    lutFile = colorLUTPath / f'{color}-{sourceHash}.npy'
+    if lutFile.exists():
+        lut = np.load(lutFile)
+    else:
+        print(f'Building {color} lookup table')
+        # Each red value is one 256 x 256 image of every green and blue value
+        G, B = np.meshgrid(np.arange(256, dtype='uint8'), np.arange(256, dtype='uint8'), indexing='ij')
+        lut = np.zeros(2**21, dtype='uint8')
+        for R in range(256):
+            chunk = np.dstack((np.full_like(G, R), G, B))
+            lut[R*2**13:(R+1)*2**13] = np.packbits(colorThresholds[color](chunk).ravel())
+        colorLUTPath.mkdir(parents=True, exist_ok=True)
+        # Parallel workers may build the same table, each writes its own temporary file
+        with tempfile.NamedTemporaryFile(dir=colorLUTPath, prefix=f'{color}-', suffix='.tmp', delete=False) as f:
+            np.save(f, lut)
+        os.replace(f.name, lutFile)
+    colorLUTs[color] = lut
+    return lut
+
+def classifyColor(RGB, color: str):
+    """
+    Applies a color threshold to an image. 8-bit RGB images are classified with
+    a lookup table from getColorLUT, anything else with the threshold function.
+
+    Inputs:
+        - RGB: RGB image
+        - color: Key of colorThresholds
+    Outputs:
+        - BW: Mask of pixels passing the threshold
+    """
+    if RGB.dtype != np.uint8 or RGB.ndim != 3 or RGB.shape[2] != 3:
+        return colorThresholds[color](RGB)
+    lut = getColorLUT(color)
+    idx = (RGB[:,:,0].astype('uint32') << 16) | (RGB[:,:,1].astype('uint32') << 8) | RGB[:,:,2]
+    BW = ((lut[idx >> 3] >> (7 - (idx & 7)).astype('uint8')) & 1).astype('bool')
+    return BW
+
+def segmentGreen(RGB):
+    """
+    Finds green pixels from Incucyte data
+    Input: RGB image
+    Output: # of green pixels and mask of green pixels
+    """
+    BW = classifyColor(RGB, 'green')
+    nGreen = np.sum(BW)
+    return nGreen, BW
 
+def segmentGreenHigh(RGB):
+    """
+    Finds very bright green pixels from Incucyte data
+    Input: RGB image
+    Output: # of green pixels and mask of green pixels
+    """
+    # Plain RGB comparisons are faster than the lookup table
+    BW = thresholdGreenHigh(RGB)
+    nGreen = np.sum(BW)
+    return nGreen, BW
+
+def segmentRed(RGB):
+    """
+    Finds red pixels from Incucyte data
+    Input: RGB image
+    Output: # of red pixels and mask of green pixels
+    """
+    BW = classifyColor(RGB, 'red')
     nRed = np.sum(BW)
     return nRed, BW
 
+def maskWindow(mask, bbox = None, margin = 2):
+    """
+    Finds a window holding every pixel of a full frame mask plus a border of background
+
+    Inputs:
+        - mask: Full frame cell mask
+        - bbox: Optional XYXY bounding box of the cell. If None the window is found from the mask
+        - margin: Pixels added around bbox, a 1 pixel border is used without a bbox
+    Outputs:
+        - window: [rowMin, rowMax, colMin, colMax] clipped to the frame, None if the mask is empty
+    """
+    if bbox is None:
+        rows = np.flatnonzero(np.any(mask, axis=1))
+        cols = np.flatnonzero(np.any(mask, axis=0))
+        if len(rows) == 0:
+            return None
+        rowMin, rowMax, colMin, colMax = rows[0], rows[-1]+1, cols[0], cols[-1]+1
+        margin = 1
+    else:
+        colMin, rowMin = int(np.floor(bbox[0])), int(np.floor(bbox[1]))
+        colMax, rowMax = int(np.ceil(bbox[2])), int(np.ceil(bbox[3]))
+    # Keep a border of background so contours close as they would in the full frame
+    rowMin, colMin = max(rowMin - margin, 0), max(colMin - margin, 0)
+    rowMax, colMax = min(rowMax + margin, mask.shape[0]), min(colMax + margin, mask.shape[1])
+    return [int(rowMin), int(rowMax), int(colMin), int(colMax)]
+
+def mask2polygon(mask, bbox = None, tolerance = 0, margin = 2, offset = (0, 0)):
+    """
+    Converts a full frame mask to a flattened polygon [x0, y0, x1, y1, ...] in the
+    format of detectron2 records. Contours are only found within a window around the cell,
+    which gives the same polygon as running find_contours on the full frame as long as the
+    window holds every pixel of the cell.
+
+    Inputs:
+        - mask: Full frame cell mask
+        - bbox: Optional XYXY bounding box of the cell. If None the window is found from the mask
+        - tolerance: Douglas-Peucker tolerance in pixels, 0 keeps every vertex
+        - margin: Pixels added around bbox. detectron2 pastes masks at most 1 pixel outside pred_boxes
+        - offset: (row, column) of mask[0, 0] in the full frame when mask is a crop
+    Outputs:
+        - poly: List of polygon coordinates, empty if no contour was found
+    """
+    window = maskWindow(mask, bbox, margin)
+    if window is None:
+        return []
+    rowMin, rowMax, colMin, colMax = window
+
+    contours = measure.find_contours(mask[rowMin:rowMax, colMin:colMax], .5)
+    if len(contours) < 1:
+        return []
+    if tolerance > 0:
+        contours = [measure.approximate_polygon(contour, tolerance) for contour in contours]
+    fullContour = np.vstack(contours)
+
+    px = fullContour[:,1] + colMin + offset[1]
+    py = fullContour[:,0] + rowMin + offset[0]
+    poly = np.column_stack((px + 0.5, py + 0.5)).ravel().tolist()
+    return poly
+
+def mask2rle(mask, bbox = None, margin = 2, offset = (0, 0)):
+    """
+    Encodes a full frame mask as an uncompressed COCO-style run length encoding of the
+    mask's own bounding box. Counts alternate between background and cell in column-major
+    order, starting with background.
+
+    Inputs:
+        - mask: Full frame cell mask
+        - bbox, margin: Optional window known to hold the cell, see maskWindow
+        - offset: (row, column) of mask[0, 0] in the full frame when mask is a crop
+    Outputs:
+        - rle: {'size': [height, width], 'counts': [...], 'offset': [row, col]} or None if the mask is empty
+    """
+    window = maskWindow(mask, bbox, margin)
+    if window is None:
+        return None
+    windowMask = mask[window[0]:window[1], window[2]:window[3]]
+    rows = np.flatnonzero(np.any(windowMask, axis=1))
+    cols = np.flatnonzero(np.any(windowMask, axis=0))
+    if len(rows) == 0:
+        return None
+    localMask = windowMask[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+
+    flat = localMask.ravel(order='F').astype('int8')
+    changes = np.flatnonzero(np.diff(flat)) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size]))).tolist()
+    if flat[0] == 1:
+        counts = [0] + counts
+    rle = {
+        'size': [int(localMask.shape[0]), int(localMask.shape[1])],
+        'counts': counts,
+        'offset': [int(offset[0] + window[0] + rows[0]), int(offset[1] + window[2] + cols[0])]
+    }
+    return rle
+
+def rle2mask(rle):
+    """
+    Decodes a run length encoding from mask2rle to a mask of its bounding box only.
+    The mask starts at rle['offset'] in the full frame.
+    """
+    values = (np.arange(len(rle['counts'])) % 2).astype('bool')
+    flat = np.repeat(values, rle['counts'])
+    return flat.reshape(rle['size'], order='F')
+
+def rleWindowMask(rle, rowStart, colStart, windowShape):
+    """
+    Decodes a run length encoding into a window
+
+    Inputs:
+        - rle: Run length encoding from mask2rle
+        - rowStart, colStart: Position of the top left of the rle's mask within the window
+        - windowShape: Shape of the window
+    Outputs:
+        - mask: Boolean mask of the cell within the window
+    """
+    localMask = rle2mask(rle)
+    mask = np.zeros(windowShape, dtype='bool')
+    rowMin, colMin = max(rowStart, 0), max(colStart, 0)
+    rowMax = min(rowStart + localMask.shape[0], windowShape[0])
+    colMax = min(colStart + localMask.shape[1], windowShape[1])
+    if rowMax > rowMin and colMax > colMin:
+        mask[rowMin:rowMax, colMin:colMax] = localMask[rowMin-rowStart:rowMax-rowStart, colMin-colStart:colMax-colStart]
+    return mask
+
+def rleTouchesBorder(rle, imgShape):
+    """
+    Checks if a cell would be removed by clear_border(binary_dilation(mask)) of its full
+    frame mask, only working on the cell's bounding box.
+
+    Inputs:
+        - rle: Run length encoding from mask2rle
+        - imgShape: Shape of the full frame
+    Outputs:
+        - touches: True if every part of the dilated cell touches the frame border
+    """
+    localMask = rle2mask(rle)
+    rowOffset, colOffset = rle['offset']
+    # Pad with background except at the frame border so dilation matches the full frame
+    padTop, padLeft = min(rowOffset, 1), min(colOffset, 1)
+    padBottom = min(imgShape[0] - rowOffset - localMask.shape[0], 1)
+    padRight = min(imgShape[1] - colOffset - localMask.shape[1], 1)
+    localMask = np.pad(localMask, ((padTop, padBottom), (padLeft, padRight)))
+    dilated = ndi.binary_dilation(localMask)
+
+    labels = measure.label(dilated)
+    # Only sides of the padded window lying on the frame border count
+    borderLabels = []
+    if rowOffset - padTop == 0:
+        borderLabels.append(labels[0, :])
+    if rowOffset + localMask.shape[0] - padTop == imgShape[0]:
+        borderLabels.append(labels[-1, :])
+    if colOffset - padLeft == 0:
+        borderLabels.append(labels[:, 0])
+    if colOffset + localMask.shape[1] - padLeft == imgShape[1]:
+        borderLabels.append(labels[:, -1])
+    if len(borderLabels) == 0:
+        return False
+    borderLabels = set(np.concatenate(borderLabels).tolist()) - {0}
+    return len(borderLabels) == labels.max()
+
 def findFluorescenceColor(RGB, mask):
     """
     Finds the fluorescence of a cell
@@ -217,6 +453,60 @@ def findFluorescenceColor(RGB, mask):
     else:
         return "NaN"
 
+def findFluorescenceColors(RGB, masks, offsets = None):
+    """
+    Finds the fluorescence of every cell in an image at once. The composite image is
+    classified once and green/red pixels are counted per cell, which gives the same
+    colors as calling findFluorescenceColor on each mask.
+
+    Inputs:
+        - RGB: Composite image
+        - masks: N x height x width stack of cell masks, or a list of cropped masks if offsets is given
+        - offsets: Optional N x 2 (row, column) of each cropped mask in the frame
+    Outputs:
+        - colors: List of "green", "red", or "NaN" for each cell
+    """
+    if offsets is not None:
+        if len(masks) == 0:
+            return []
+        _, green = segmentGreen(RGB)
+        _, red = segmentRed(RGB)
+        nGreen, nRed = np.zeros(len(masks), dtype='int64'), np.zeros(len(masks), dtype='int64')
+        for n, (mask, (row, col)) in enumerate(zip(masks, offsets)):
+            window = (slice(row, row + mask.shape[0]), slice(col, col + mask.shape[1]))
+            nGreen[n] = np.sum(mask & green[window])
+            nRed[n] = np.sum(mask & red[window])
+        colors = np.full(len(masks), 'NaN', dtype='<U5')
+        colors[nRed >= nGreen+100] = 'red'
+        colors[nGreen >= nRed+100] = 'green'
+        return colors.tolist()
+
+    masks = np.asarray(masks).astype('bool')
+    nCells = masks.shape[0]
+    if nCells == 0:
+        return []
+    _, green = segmentGreen(RGB)
+    _, red = segmentRed(RGB)
+
+    # Label map of pixels covered by exactly one cell, 0 is background or overlap
+    coverage = masks.sum(axis=0)
+    labels = np.argmax(masks, axis=0) + 1
+    labels[coverage != 1] = 0
+    nGreen = np.bincount(labels[green], minlength=nCells+1)[1:]
+    nRed = np.bincount(labels[red], minlength=nCells+1)[1:]
+
+    # Pixels shared by several cells count toward each of them
+    overlap = coverage > 1
+    if overlap.any():
+        overlapMasks = masks[:, overlap]
+        nGreen = nGreen + (overlapMasks & green[overlap]).sum(axis=1)
+        nRed = nRed + (overlapMasks & red[overlap]).sum(axis=1)
+
+    colors = np.full(nCells, 'NaN', dtype='<U5')
+    colors[nRed >= nGreen+100] = 'red'
+    colors[nGreen >= nRed+100] = 'green'
+    return colors.tolist()
+
 def findBrightGreen(RGB, mask, thresh = 10):
     """
     Finds the fluorescence of a cell
@@ -254,13 +544,18 @@ def filterCells(cells, confluencyDate=False, edge=False, color=False):
     print(f'Filtered out {nCells-nCellsNew} cells')
     return cells
 
-def preprocess(input_image, magnification_downsample_factor=1.0):
+def preprocess(input_image, magnification_downsample_factor=1.0, backgroundDownsample=1, backgroundCache=None, cacheKey=None):
     """
     preprocesses an image taken by the Incucyte so that it will be normalized
     Taken from LIVECell paper: https://github.com/sartorius-research/LIVECell
     Inputs:
     input_image: Image to be analyzed
     magnification_downsample_factor: For other magnifications
+    backgroundDownsample: Estimate the background on an image this many times smaller, then upsample it.
+        1 is the exact LIVECell normalization, see preprocessAccuracy for the error of other values
+    backgroundCache: Optional dictionary holding backgrounds. Illumination barely changes over a
+        time-lapse, so the background of one frame can be reused for every frame of the same position
+    cacheKey: Key of the background in backgroundCache, e.g. well and well section 'B2_1'
     Outputs:
     output_image: Processed image
     """ 
@@ -270,6 +565,9 @@ def preprocess(input_image, magnification_downsample_factor=1.0):
     #   target_median = 128 -- LIVECell phase contrast images all center around a 128 intensity
     median_radius_raw = 75
     target_median = 128.0
+    if backgroundCache is not None and cacheKey is None:
+        print('A cacheKey is needed to store backgrounds, e.g. well and well section')
+        raise ValueError('cacheKey must be given with backgroundCache')
     
     #large median filter kernel size is dependent on resize factor, and must also be odd
     median_radius = round(median_radius_raw*magnification_downsample_factor)
@@ -294,7 +592,13 @@ def preprocess(input_image, magnification_downsample_factor=1.0):
     output_image[output_image < 0] = 0
 
     #estimate background illumination pattern using the large median filter
-    background = cv2.medianBlur(output_image.astype('uint8'), median_radius)
+    #cached backgrounds are stored without the intensity scaling of their frame
+    if backgroundCache is not None and cacheKey in backgroundCache.keys():
+        background = backgroundCache[cacheKey]*intensity_scale
+    else:
+        background = estimateBackground(output_image, median_radius, backgroundDownsample)
+        if backgroundCache is not None:
+            backgroundCache[cacheKey] = background.astype('float')/intensity_scale
     output_image = output_image.astype('float')/background.astype('float')*target_median
 
     #clipping for zernike phase halo artifacts
@@ -303,6 +607,59 @@ def preprocess(input_image, magnification_downsample_factor=1.0):
     output_image = output_image.astype('uint8')
 
     return output_image
+
+def estimateBackground(image, median_radius, backgroundDownsample=1):
+    """
+    Estimates the background illumination of an image with a large median filter
+
+    Inputs:
+    image: Image clipped to 0-255
+    median_radius: Odd kernel size of the median filter at full resolution
+    backgroundDownsample: Filter an image this many times smaller with a proportionally smaller kernel
+    Outputs:
+    background: Background at the resolution of image
+    """
+    if backgroundDownsample <= 1:
+        return cv2.medianBlur(image.astype('uint8'), median_radius)
+    dims = image.shape
+    ySmall = max(int(dims[0]/backgroundDownsample), 1)
+    xSmall = max(int(dims[1]/backgroundDownsample), 1)
+    imageSmall = cv2.resize(image.astype('float32'), (xSmall, ySmall), interpolation = cv2.INTER_AREA)
+    radiusSmall = max(round(median_radius/backgroundDownsample), 3)
+    if radiusSmall%2==0:
+        radiusSmall=radiusSmall+1
+    backgroundSmall = cv2.medianBlur(np.round(imageSmall).astype('uint8'), radiusSmall)
+    background = cv2.resize(backgroundSmall.astype('float32'), (dims[1], dims[0]), interpolation = cv2.INTER_LINEAR)
+    return background
+
+def preprocessAccuracy(images, backgroundDownsample, magnification_downsample_factor=1.0):
+    """
+    Compares preprocessing with a downsampled background against the exact LIVECell preprocessing
+
+    Inputs:
+    images: List of images
+    backgroundDownsample: Downsampling used for the background
+    magnification_downsample_factor: For other magnifications
+    Outputs:
+    report: Dictionary of the mean and max absolute difference and the fraction of pixels
+        differing by more than 1 and by more than 5 intensity values
+    """
+    diffs = []
+    for image in images:
+        exact = preprocess(image, magnification_downsample_factor).astype('int16')
+        fast = preprocess(image, magnification_downsample_factor, backgroundDownsample).astype('int16')
+        diffs.append(np.abs(exact - fast).ravel())
+    diffs = np.concatenate(diffs)
+    report = {
+        'meanAbsDiff': float(np.mean(diffs)),
+        'maxAbsDiff': int(np.max(diffs)),
+        'fracDiffOver1': float(np.mean(diffs > 1)),
+        'fracDiffOver5': float(np.mean(diffs > 5))
+    }
+    print(f"Downsample {backgroundDownsample}: mean difference {report['meanAbsDiff']:0.3f}, max difference {report['maxAbsDiff']}, "
+          f"{100*report['fracDiffOver1']:0.2f}% of pixels off by >1, {100*report['fracDiffOver5']:0.2f}% off by >5")
+    return report
+
 # %% Expanding image segmentation to larger image
 def split2WholeCoords(nIms, wholeImgSize):
     """
@@ -367,7 +724,66 @@ def expandImageSegmentation(poly, bb, splitNum, coords, padNum=200):
     
     return [polyxWhole, polyyWhole, bbWhole]
 
-def bbIncrease(poly, bb, imgName, imgWhole, nIms, nIncrease=50, padNum=200, augmentation = None):
+def padCropWindow(img, padNum, rowMin, rowMax, colMin, colMax):
+    """
+    Crops a window out of an image as if the image were first padded with padNum zeros,
+    but only allocates the window itself. Equivalent to:
+    np.pad(img, (padNum, padNum))[rowMin:rowMax, colMin:colMax]
+
+    Inputs:
+    - img: Whole image
+    - padNum: Virtual padding on every side of the image
+    - rowMin, rowMax, colMin, colMax: Window in padded coordinates
+
+    Outputs:
+    - window: Cropped window
+    - rowStart, colStart: Padded coordinates of the top left of the window
+    """
+    paddedShape = [dim + 2*padNum for dim in img.shape]
+    # Follow python slicing rules so the result matches slicing the padded image
+    rowStart, rowStop, _ = slice(rowMin, rowMax).indices(paddedShape[0])
+    colStart, colStop, _ = slice(colMin, colMax).indices(paddedShape[1])
+    nRows = max(rowStop - rowStart, 0)
+    nCols = max(colStop - colStart, 0)
+    window = np.zeros([nRows, nCols] + paddedShape[2:], dtype=img.dtype)
+
+    # Part of the window that overlaps the real image
+    r0, r1 = max(rowStart, padNum), min(rowStop, padNum + img.shape[0])
+    c0, c1 = max(colStart, padNum), min(colStop, padNum + img.shape[1])
+    if r1 > r0 and c1 > c0:
+        # np.pad also pads any trailing (channel) axes
+        trailing = tuple(slice(padNum, padNum + dim) for dim in img.shape[2:])
+        windowIdx = (slice(r0 - rowStart, r1 - rowStart), slice(c0 - colStart, c1 - colStart)) + trailing
+        window[windowIdx] = img[r0 - padNum:r1 - padNum, c0 - padNum:c1 - padNum]
+    return window, rowStart, colStart
+
+def polygonWindowMask(polyRows, polyCols, paddedShape, rowStart, colStart, windowShape):
+    """
+    Rasterizes a polygon only within a window. Pixel-identical to slicing
+    polygon2mask(paddedShape, polygon) since the polygon is filled in padded coordinates
+    and only the fill inside the polygon's bounding box is visited.
+
+    Inputs:
+    - polyRows, polyCols: Polygon vertices in padded coordinates
+    - paddedShape: Shape of the padded image
+    - rowStart, colStart: Padded coordinates of the top left of the window
+    - windowShape: Shape of the window
+
+    Outputs:
+    - mask: Boolean mask of the polygon within the window
+    """
+    polyRows = np.asarray(polyRows, dtype='float')
+    polyCols = np.asarray(polyCols, dtype='float')
+    rr, cc = polygon(polyRows, polyCols, paddedShape)
+    rr = rr - rowStart
+    cc = cc - colStart
+    isInside = (rr >= 0) & (rr < windowShape[0]) & (cc >= 0) & (cc < windowShape[1])
+
+    mask = np.zeros(windowShape, dtype='bool')
+    mask[rr[isInside], cc[isInside]] = True
+    return mask
+
+def bbIncrease(poly, bb, imgName, imgWhole, nIms, nIncrease=50, padNum=200, augmentation = None, rle = None):
     """
     Takes in a segmentation from a split image and outputs the segmentation from the whole image. 
     Inputs: 
@@ -377,13 +793,17 @@ def bbIncrease(poly, bb, imgName, imgWhole, nIms, nIncrease=50, padNum=200, augm
     - imgWhole: The whole image from which the final crop will come from
     - nIncrease: The amount to increase the bounding box
     - padNum: The padding on the whole image, necessary to segment properly
+    - rle: Optional run length encoded mask from mask2rle, decoded instead of filling the polygon
 
     Outputs:
     - imgBBWholeExpand: The image cropped from the whole image increased by nIncrease
+
+    NOTE: The whole image is never padded, only the crop window is built, so the cost
+    scales with the size of the cell rather than the image.
     """
     splitNum = int(imgName.split('_')[-1].split('.')[0])
     coords = split2WholeCoords(nIms, wholeImgSize = imgWhole.shape)
-    imgWhole = np.pad(imgWhole, (padNum,padNum))
+    paddedShape = tuple(dim + 2*padNum for dim in imgWhole.shape)
     polyxWhole, polyyWhole, bbWhole = expandImageSegmentation(poly, bb, splitNum, coords, padNum)
     bbWhole = [int(corner) for corner in bbWhole]
     colMin, rowMin, colMax, rowMax = bbWhole
@@ -392,28 +812,34 @@ def bbIncrease(poly, bb, imgName, imgWhole, nIms, nIncrease=50, padNum=200, augm
     colMin -= nIncrease
     colMax += nIncrease
 
-    if augmentation == 'blackoutCell':
-        maskBlackout  = polygon2mask(imgWhole.shape, np.array([polyyWhole, polyxWhole], dtype="object").T)
+    imgBBWholeExpand, rowStart, colStart = padCropWindow(imgWhole, padNum, rowMin, rowMax, colMin, colMax)
 
-        imgWhole[maskBlackout] = 255
+    if augmentation in ['blackoutCell', 'stamp', 'shape'] and rle is None:
+        maskBlackout = polygonWindowMask(polyyWhole, polyxWhole, paddedShape, rowStart, colStart, imgBBWholeExpand.shape)
+    elif augmentation in ['blackoutCell', 'stamp', 'shape']:
+        cIncrease = coords[splitNum]
+        maskBlackout = rleWindowMask(rle,
+                                     rle['offset'][0] + cIncrease[1] + padNum - rowStart,
+                                     rle['offset'][1] + cIncrease[0] + padNum - colStart,
+                                     imgBBWholeExpand.shape)
+
+    if augmentation == 'blackoutCell':
+        imgBBWholeExpand[maskBlackout] = 255
 
     if augmentation == 'outline':
-            rr, cc = polygon_perimeter(polyyWhole, polyxWhole)
-            imgWhole = np.zeros(imgWhole.shape)
-            imgWhole[rr, cc] = 1
+        rr, cc = polygon_perimeter(polyyWhole, polyxWhole)
+        rr = rr - rowStart
+        cc = cc - colStart
+        isInside = (rr >= 0) & (rr < imgBBWholeExpand.shape[0]) & (cc >= 0) & (cc < imgBBWholeExpand.shape[1])
+        imgBBWholeExpand = np.zeros(imgBBWholeExpand.shape)
+        imgBBWholeExpand[rr[isInside], cc[isInside]] = 1
 
     if augmentation == 'stamp':
-        maskBlackout  = polygon2mask(imgWhole.shape, np.array([polyyWhole, polyxWhole], dtype="object").T)
-
-        imgWhole[~maskBlackout] = 0
+        imgBBWholeExpand[~maskBlackout] = 0
 
     if augmentation == 'shape':
-        maskBlackout  = polygon2mask(imgWhole.shape, np.array([polyyWhole, polyxWhole], dtype="object").T)
-        imgWhole = maskBlackout
-
+        imgBBWholeExpand = maskBlackout
 
-    bbIncrease = [colMin, rowMin, colMax, rowMax]
-    imgBBWholeExpand = imgWhole[bbIncrease[1]:bbIncrease[3], bbIncrease[0]:bbIncrease[2]]
     return imgBBWholeExpand
 
 def bbIncreaseBlackout(poly, bb, imgName, imgWhole, nIms, label, nIncrease=50, padNum=200):
@@ -431,11 +857,9 @@ def bbIncreaseBlackout(poly, bb, imgName, imgWhole, nIms, label, nIncrease=50, p
     Outputs:
     - imgBBWholeExpand: The image cropped from the whole image increased by nIncrease where the cell is all black (0s)
     """
-  
-
     splitNum = int(imgName.split('_')[-1].split('.')[0])
     coords = split2WholeCoords(nIms, wholeImgSize = imgWhole.shape)
-    imgWhole = np.pad(imgWhole, (padNum,padNum))
+    paddedShape = tuple(dim + 2*padNum for dim in imgWhole.shape)
     polyxWhole, polyyWhole, bbWhole = expandImageSegmentation(poly, bb, splitNum, coords, padNum)
     bbWhole = [int(corner) for corner in bbWhole]
     colMin, rowMin, colMax, rowMax = bbWhole
@@ -443,18 +867,134 @@ def bbIncreaseBlackout(poly, bb, imgName, imgWhole, nIms, label, nIncrease=50, p
     rowMax += nIncrease
     colMin -= nIncrease
     colMax += nIncrease
-    
-    maskBlackout  = polygon2mask(imgWhole.shape, np.array([polyyWhole, polyxWhole], dtype="object").T)
 
-    imgWhole[maskBlackout] = 0
-
-    
-    bbIncrease = [colMin, rowMin, colMax, rowMax]
-    imgBBWholeExpand = imgWhole[bbIncrease[1]:bbIncrease[3], bbIncrease[0]:bbIncrease[2]]
-    
+    imgBBWholeExpand, rowStart, colStart = padCropWindow(imgWhole, padNum, rowMin, rowMax, colMin, colMax)
+    maskBlackout = polygonWindowMask(polyyWhole, polyxWhole, paddedShape, rowStart, colStart, imgBBWholeExpand.shape)
+    imgBBWholeExpand[maskBlackout] = 0
 
     return imgBBWholeExpand
 
+def letterboxCrop(imgCrop, maxImgSize):
+    """
+    Pads a crop evenly with zeros up to maxImgSize, then resizes it to be square.
+    Crops larger than maxImgSize are not padded and are only resized.
+
+    Inputs:
+    - imgCrop: Crop from bbIncrease
+    - maxImgSize: Final number of rows and columns
+
+    Outputs:
+    - imgLetterbox: maxImgSize x maxImgSize float image scaled between 0 and 1
+    """
+    diffRows = max(int((maxImgSize - imgCrop.shape[0])/2), 0)
+    diffCols = max(int((maxImgSize - imgCrop.shape[1])/2), 0)
+    imgCrop = np.pad(imgCrop, ((diffRows, diffRows), (diffCols, diffCols)))
+    imgLetterbox = resize(imgCrop, (maxImgSize, maxImgSize))
+    return imgLetterbox
+
+def bbIncreaseWindows(bbs, imgNames, wholeImgShape, nIms, nIncrease=50, padNum=200):
+    """
+    Finds the crop windows bbIncrease would use for many cells of the same whole image
+
+    Inputs:
+    - bbs: Kx4 bounding boxes in split image coordinates (datasetDict format)
+    - imgNames: Name of the split image each cell was found in
+    - wholeImgShape: Shape of the whole image
+    - nIms: Number of images the whole image was split into
+    - nIncrease: The amount to increase the bounding box
+    - padNum: The padding on the whole image
+
+    Outputs:
+    - windows: Kx4 integer array of [rowMin, rowMax, colMin, colMax] in padded coordinates
+    """
+    coords = split2WholeCoords(nIms, wholeImgSize = wholeImgShape)
+    splitNums = [int(imgName.split('_')[-1].split('.')[0]) for imgName in imgNames]
+    offsets = np.array([coords[splitNum] for splitNum in splitNums]).reshape(-1, 2)
+    bbs = np.asarray(bbs).reshape(-1, 4)
+
+    # Same arithmetic as expandImageSegmentation followed by int()
+    colMin = (bbs[:, 0] + offsets[:, 0] + padNum).astype('int') - nIncrease
+    rowMin = (bbs[:, 1] + offsets[:, 1] + padNum).astype('int') - nIncrease
+    colMax = (bbs[:, 2] + offsets[:, 0] + padNum).astype('int') + nIncrease
+    rowMax = (bbs[:, 3] + offsets[:, 1] + padNum).astype('int') + nIncrease
+    windows = np.stack([rowMin, rowMax, colMin, colMax], axis=1)
+    return windows
+
+def cropResizeROIs(imgWhole, windows, maxImgSize, padNum=200):
+    """
+    Crops, letterboxes, and resizes many cells from one whole image in a single
+    vectorized gather. Each output pixel is bilinearly sampled from the padded crop
+    with the same pixel-center geometry and mirrored edges as letterboxCrop, without
+    ever building the crops.
+
+    Crops larger than maxImgSize are anti-aliased by resize, so they are passed
+    through padCropWindow and letterboxCrop instead. These are rare.
+
+    Inputs:
+    - imgWhole: 2D whole image
+    - windows: Kx4 [rowMin, rowMax, colMin, colMax] in padded coordinates, see bbIncreaseWindows
+    - maxImgSize: Final size of each crop
+    - padNum: Virtual zero padding around the whole image
+
+    Outputs:
+    - crops: K x maxImgSize x maxImgSize float array scaled between 0 and 1
+    """
+    windows = np.asarray(windows).reshape(-1, 4)
+    nRows, nCols = imgWhole.shape[0:2]
+    paddedShape = (nRows + 2*padNum, nCols + 2*padNum)
+    # Windows are clipped to the padded image
+    rowMin = np.clip(windows[:, 0], 0, paddedShape[0])
+    rowMax = np.clip(windows[:, 1], rowMin, paddedShape[0])
+    colMin = np.clip(windows[:, 2], 0, paddedShape[1])
+    colMax = np.clip(windows[:, 3], colMin, paddedShape[1])
+
+    def sampleAxis(start, stop, nImg):
+        """Returns neighbor indices, weights, and validity for one axis of every crop"""
+        size = stop - start
+        diff = np.maximum(((maxImgSize - size)/2).astype('int'), 0)
+        sizePadded = size + 2*diff
+        # Pixel centers of the output mapped into the letterboxed crop
+        scale = sizePadded/maxImgSize
+        coord = (np.arange(maxImgSize)[None, :] + 0.5)*scale[:, None] - 0.5
+        low = np.floor(coord).astype('int')
+        high = np.ceil(coord).astype('int')
+        weight = coord - low
+        neighbors = []
+        for idx in [low, high]:
+            # Mirror neighbors that fall outside the letterboxed crop
+            cmax = sizePadded[:, None] - 1
+            idx = np.where(idx < 0, -idx, idx)
+            idx = np.where(idx > cmax, 2*cmax - idx, idx)
+            idx = np.clip(idx, 0, np.maximum(cmax, 0))
+            # Remove the letterbox padding, then the virtual image padding
+            inCrop = (idx >= diff[:, None]) & (idx < (diff + size)[:, None])
+            imgIdx = idx - diff[:, None] + start[:, None] - padNum
+            isValid = inCrop & (imgIdx >= 0) & (imgIdx < nImg)
+            neighbors.append((np.where(isValid, imgIdx, 0), isValid))
+        return neighbors, weight, sizePadded
+
+    rowNeighbors, rowWeight, rowsPadded = sampleAxis(rowMin, rowMax, nRows)
+    colNeighbors, colWeight, colsPadded = sampleAxis(colMin, colMax, nCols)
+
+    def gather(rowNeighbor, colNeighbor):
+        rowIdx, rowValid = rowNeighbor
+        colIdx, colValid = colNeighbor
+        vals = img_as_float(imgWhole[rowIdx[:, :, None], colIdx[:, None, :]])
+        return vals*(rowValid[:, :, None] & colValid[:, None, :])
+
+    dr = rowWeight[:, :, None]
+    dc = colWeight[:, None, :]
+    top = (1 - dc)*gather(rowNeighbors[0], colNeighbors[0]) + dc*gather(rowNeighbors[0], colNeighbors[1])
+    bottom = (1 - dc)*gather(rowNeighbors[1], colNeighbors[0]) + dc*gather(rowNeighbors[1], colNeighbors[1])
+    crops = (1 - dr)*top + dr*bottom
+
+    # Downsampled crops need anti-aliasing
+    isLarge = (rowsPadded > maxImgSize) | (colsPadded > maxImgSize)
+    for k in np.where(isLarge)[0]:
+        imgCrop, _, _ = padCropWindow(imgWhole, padNum, rowMin[k], rowMax[k], colMin[k], colMax[k])
+        crops[k] = letterboxCrop(imgCrop, maxImgSize)
+    return crops
+
 # %% Perimeter and "classic" cell morphology
 def interpolatePerimeter(perim: np.array, nPts: int=150):
     """
@@ -475,6 +1015,95 @@ def interpolatePerimeter(perim: np.array, nPts: int=150):
     
     return perimInt
 
+def arcLengthAxis(coords, offsets):
+    """
+    Normalized arc length of every point of many contours placed on one increasing axis.
+    Contour k covers [2k, 2k+1], so a single np.interp or np.searchsorted works on all contours.
+    Inputs:
+    coords: (M, 2) coordinates of all contours one after another
+    offsets: (N+1,) start of each contour in coords, with offsets[-1] = M
+    Outputs:
+    axis: (M,) position of each point on the axis
+    contourIdx: (M,) contour of each point
+    """
+    offsets = np.asarray(offsets)
+    nContours = len(offsets) - 1
+    contourIdx = np.repeat(np.arange(nContours), np.diff(offsets))
+    segment = np.sqrt(np.sum(np.diff(coords, axis=0)**2, axis=1))
+    segment = np.insert(segment, 0, 0)
+    # The first point of each contour starts its own distance
+    segment[offsets[:-1][np.diff(offsets) > 0]] = 0
+    distance = np.cumsum(segment)
+    starts = distance[np.minimum(offsets[:-1], len(distance)-1)]
+    distance = distance - starts[contourIdx]
+    totals = np.zeros(nContours)
+    nonEmpty = np.diff(offsets) > 0
+    totals[nonEmpty] = distance[offsets[1:][nonEmpty] - 1]
+    totals[totals == 0] = 1
+    axis = 2*contourIdx + distance/totals[contourIdx]
+    return axis, contourIdx
+
+def interpolatePerimeters(coords, offsets, nPts: int=150, kind: str='linear'):
+    """
+    Interpolates many 2D curves to nPts points evenly spaced by arc length at once.
+    Inputs:
+    coords: (M, 2) coordinates of all contours one after another
+    offsets: (N+1,) start of each contour in coords, with offsets[-1] = M. Contours must not be empty
+    nPts: Number of interpolated points
+    kind: 'linear' to connect points with lines, or 'catmullRom' for a closed, uniform Catmull-Rom spline
+    through the points. This is a local cubic, not the global periodic cubic spline of scipy's CubicSpline.
+    Outputs:
+    perimsInt: (N, nPts, 2) interpolated perimeters. Contours with a single point or no length repeat their first point
+    """
+    coords = np.asarray(coords, dtype='float')
+    offsets = np.asarray(offsets, dtype='int64')
+    nContours = len(offsets) - 1
+    alpha = np.linspace(0, 1, nPts)
+    query = (2*np.arange(nContours)[:,None] + alpha[None,:]).ravel()
+
+    if kind == 'linear':
+        axis, _ = arcLengthAxis(coords, offsets)
+        perimsInt = np.stack([np.interp(query, axis, coords[:,0]), np.interp(query, axis, coords[:,1])], axis=1)
+        perimsInt = perimsInt.reshape(nContours, nPts, 2)
+        # Without any length np.interp would run on into the next contour
+        isPoint = axis[offsets[1:]-1] == 2*np.arange(nContours)
+        perimsInt[isPoint] = coords[offsets[:-1][isPoint]][:,None,:]
+        return perimsInt
+    if kind != 'catmullRom':
+        raise ValueError(f'kind must be linear or catmullRom, not {kind}')
+
+    # Drop the repeated end point of closed contours, then close every contour explicitly
+    starts, ends = offsets[:-1], offsets[1:]
+    isClosed = np.zeros(nContours, dtype='bool')
+    multiple = ends - starts > 1
+    isClosed[multiple] = np.all(coords[starts[multiple]] == coords[ends[multiple]-1], axis=1)
+    keep = np.ones(len(coords), dtype='bool')
+    keep[ends[isClosed] - 1] = False
+    unique = coords[keep]
+    nUnique = np.diff(offsets) - isClosed
+    uniqueOffsets = np.concatenate(([0], np.cumsum(nUnique)))
+    closed = np.insert(unique, uniqueOffsets[1:], unique[uniqueOffsets[:-1]], axis=0)
+    closedOffsets = uniqueOffsets + np.arange(nContours+1)
+
+    axis, contourIdx = arcLengthAxis(closed, closedOffsets)
+    queryIdx = np.repeat(np.arange(nContours), nPts)
+    segmentIdx = np.searchsorted(axis, query, side='right') - 1
+    segmentIdx = np.clip(segmentIdx, closedOffsets[:-1][queryIdx], closedOffsets[1:][queryIdx] - 2)
+    segmentLength = axis[segmentIdx+1] - axis[segmentIdx]
+    segmentLength[segmentLength == 0] = 1
+    u = ((query - axis[segmentIdx])/segmentLength)[:,None]
+
+    # Control points wrap around each contour
+    n = nUnique[queryIdx]
+    local = segmentIdx - closedOffsets[:-1][queryIdx]
+    start = uniqueOffsets[:-1][queryIdx]
+    P0 = unique[start + (local-1) % n]
+    P1 = unique[start + local % n]
+    P2 = unique[start + (local+1) % n]
+    P3 = unique[start + (local+2) % n]
+    perimsInt = 0.5*(2*P1 + (-P0 + P2)*u + (2*P0 - 5*P1 + 4*P2 - P3)*u**2 + (-P0 + 3*P1 - 3*P2 + P3)*u**3)
+    return perimsInt.reshape(nContours, nPts, 2)
+
 def procrustes(X, Y, scaling=False, reflection='best'):
     """
     A port of MATLAB's `procrustes` function to Numpy.
@@ -577,67 +1206,91 @@ def procrustes(X, Y, scaling=False, reflection='best'):
 
     return d, Z, tform
 
-def extractFeatures(image, mask, perim):
+def importPyfeats():
+    """
+    Imports pyfeats (https://github.com/giakou4/pyfeats), which is only needed for texture features
+    """
+    try:
+        import pyfeats
+    except ImportError as e:
+        raise ImportError('Texture features need pyfeats, install it with pip install pyfeats') from e
+    return pyfeats
+
+# Feature families of extractFeatures, each called with (image, mask, perim)
+featureFamilies = {
+    'A_FOS':             lambda image, mask, perim: importPyfeats().fos(image, mask),
+    'A_GLCM':            lambda image, mask, perim: importPyfeats().glcm_features(image, ignore_zeros=True),
+    'A_GLDS':            lambda image, mask, perim: importPyfeats().glds_features(image, mask, Dx=[0,1,1,1], Dy=[1,1,0,-1]),
+    'A_NGTDM':           lambda image, mask, perim: importPyfeats().ngtdm_features(image, mask, d=1),
+    'A_SFM':             lambda image, mask, perim: importPyfeats().sfm_features(image, mask, Lr=4, Lc=4),
+    'A_LTE':             lambda image, mask, perim: importPyfeats().lte_measures(image, mask, l=7),
+    'A_FDTA':            lambda image, mask, perim: importPyfeats().fdta(image, mask, s=3),
+    'A_GLRLM':           lambda image, mask, perim: importPyfeats().glrlm_features(image, mask, Ng=256),
+    'A_FPS':             lambda image, mask, perim: importPyfeats().fps(image, mask),
+    'A_Shape_par':       lambda image, mask, perim: importPyfeats().shape_parameters(image, mask, perim, pixels_per_mm2=1),
+    'A_HOS':             lambda image, mask, perim: importPyfeats().hos_features(image, th=[135,140]),
+    'A_LBP':             lambda image, mask, perim: importPyfeats().lbp_features(image, image, P=[8,16,24], R=[1,2,3]),
+    'A_GLSZM':           lambda image, mask, perim: importPyfeats().glszm_features(image, mask),
+
+    #% B. Morphological features
+    # 'B_Morphological_Grayscale': lambda image, mask, perim: importPyfeats().grayscale_morphology_features(image, N=30),
+    # 'B_Morphological_Binary':    lambda image, mask, perim: importPyfeats().multilevel_binary_morphology_features(image, mask, N=30, thresholds=[25,50]),
+    #% C. Histogram Based features
+    # 'C_Histogram':               lambda image, mask, perim: importPyfeats().histogram(image, mask, bins=32),
+    # 'C_MultiregionHistogram':    lambda image, mask, perim: importPyfeats().multiregion_histogram(image, mask, bins=32, num_eros=3, square_size=3),
+    # 'C_Correlogram':             lambda image, mask, perim: importPyfeats().correlogram(image, mask, bins_digitize=32, bins_hist=32, flatten=True),
+    #% D. Multi-Scale features
+    'D_DWT':             lambda image, mask, perim: importPyfeats().dwt_features(image, mask, wavelet='bior3.3', levels=3),
+    'D_SWT':             lambda image, mask, perim: importPyfeats().swt_features(image, mask, wavelet='bior3.3', levels=3),
+    # 'D_WP':            lambda image, mask, perim: importPyfeats().wp_features(image, mask, wavelet='coif1', maxlevel=3),
+    'D_GT':              lambda image, mask, perim: importPyfeats().gt_features(image, mask),
+    'D_AMFM':            lambda image, mask, perim: importPyfeats().amfm_features(image),
+
+    #% E. Other
+    # 'E_HOG':           lambda image, mask, perim: importPyfeats().hog_features(image, ppc=8, cpb=3),
+    'E_HuMoments':       lambda image, mask, perim: importPyfeats().hu_moments(image),
+    # 'E_TAS':           lambda image, mask, perim: importPyfeats().tas_features(image),
+    'E_ZernikesMoments': lambda image, mask, perim: importPyfeats().zernikes_moments(image, radius=9),
+}
+
+def flattenFeatures(featureLabel):
+    """
+    Flattens the output of one pyfeats family
+
+    Inputs:
+        - featureLabel: Either (features, labels) or features followed by the same number of labels
+    Outputs:
+        - features: List of features
+        - labels: List of feature names
+    """
+    if len(featureLabel) == 2:
+        return featureLabel[0].tolist(), list(featureLabel[1])
+    assert len(featureLabel)%2 == 0
+    nFeature = int(len(featureLabel)/2)
+    features = list(itertools.chain.from_iterable(featureLabel[0:nFeature]))
+    labels = list(itertools.chain.from_iterable(featureLabel[nFeature:]))
+    return features, labels
+
+def extractFeatures(image, mask, perim, families = None):
     """
     A wrapper function for pyfeats (https://github.com/giakou4/pyfeats) to extract parameters
     Inputs:
     f: A grayscale image scaled between 0 and 255
     mask: A mask of ints where the cell is located
     perim: The perimeter of the cell
+    families: Keys of featureFamilies to extract, defaults to all
 
     Outputs:
     allLabels: List of descriptors for each feature
     allFeatures: List of features for the given image
     """
-
-    features = {}
-    features['A_FOS']       = pyfeats.fos(image, mask)
-    features['A_GLCM']      = pyfeats.glcm_features(image, ignore_zeros=True)
-    features['A_GLDS']      = pyfeats.glds_features(image, mask, Dx=[0,1,1,1], Dy=[1,1,0,-1])
-    features['A_NGTDM']     = pyfeats.ngtdm_features(image, mask, d=1)
-    features['A_SFM']       = pyfeats.sfm_features(image, mask, Lr=4, Lc=4)
-    features['A_LTE']       = pyfeats.lte_measures(image, mask, l=7)
-    features['A_FDTA']      = pyfeats.fdta(image, mask, s=3)
-    features['A_GLRLM']     = pyfeats.glrlm_features(image, mask, Ng=256)
-    features['A_FPS']       = pyfeats.fps(image, mask)
-    features['A_Shape_par'] = pyfeats.shape_parameters(image, mask, perim, pixels_per_mm2=1)
-    features['A_HOS']       = pyfeats.hos_features(image, th=[135,140])
-    features['A_LBP']       = pyfeats.lbp_features(image, image, P=[8,16,24], R=[1,2,3])
-    features['A_GLSZM']     = pyfeats.glszm_features(image, mask)
-
-    #% B. Morphological features
-    # features['B_Morphological_Grayscale_pdf'], features['B_Morphological_Grayscale_cdf'] = pyfeats.grayscale_morphology_features(image, N=30)
-    # features['B_Morphological_Binary_L_pdf'], features['B_Morphological_Binary_M_pdf'], features['B_Morphological_Binary_H_pdf'], features['B_Morphological_Binary_L_cdf'], \
-    # features['B_Morphological_Binary_M_cdf'], features['B_Morphological_Binary_H_cdf'] = pyfeats.multilevel_binary_morphology_features(image, mask, N=30, thresholds=[25,50])
-    #% C. Histogram Based features
-    # features['C_Histogram'] =               pyfeats.histogram(image, mask, bins=32)
-    # features['C_MultiregionHistogram'] =    pyfeats.multiregion_histogram(image, mask, bins=32, num_eros=3, square_size=3)
-    # features['C_Correlogram'] =             pyfeats.correlogram(image, mask, bins_digitize=32, bins_hist=32, flatten=True)
-    #% D. Multi-Scale features
-    features['D_DWT'] =     pyfeats.dwt_features(image, mask, wavelet='bior3.3', levels=3)
-    features['D_SWT'] =     pyfeats.swt_features(image, mask, wavelet='bior3.3', levels=3)
-    # features['D_WP'] =      pyfeats.wp_features(image, mask, wavelet='coif1', maxlevel=3)
-    features['D_GT'] =      pyfeats.gt_features(image, mask)
-    features['D_AMFM'] =    pyfeats.amfm_features(image)
-
-    #% E. Other
-    # features['E_HOG'] =             pyfeats.hog_features(image, ppc=8, cpb=3)
-    features['E_HuMoments'] =       pyfeats.hu_moments(image)
-    # features['E_TAS'] =             pyfeats.tas_features(image)
-    features['E_ZernikesMoments'] = pyfeats.zernikes_moments(image, radius=9)
-    # Try to make a data frame out of it
+    if families is None:
+        families = featureFamilies.keys()
     allFeatures, allLabels = [], []
-    for label, featureLabel in features.items():
-
-        if len(featureLabel) == 2:
-            allFeatures += featureLabel[0].tolist()
-            allLabels += featureLabel[1]
-        else:
-            assert len(featureLabel)%2 == 0
-            nFeature = int(len(featureLabel)/2)
-
-            allFeatures += list(itertools.chain.from_iterable(featureLabel[0:nFeature]))
-            allLabels += list(itertools.chain.from_iterable(featureLabel[nFeature:]))
+    for family in families:
+        features, labels = flattenFeatures(featureFamilies[family](image, mask, perim))
+        allFeatures += features
+        allLabels += labels
     return allFeatures, allLabels
 
 def alignPerimeters(cells: list):
@@ -673,3 +1326,102 @@ def alignPerimeters(cells: list):
         cell.perimAligned = currentPerim2 - np.mean(currentPerim2, axis=0)
     return cells
 
+
+def procrustesBatch(X, Y, scaling=False, reflection='best'):
+    """
+    procrustes for many shapes at once. Every shape in Y is aligned to its target in X
+    using stacked SVDs, giving the same results as calling procrustes on each pair.
+    Inputs:
+    X: Target coordinates of shape (nPts, m), shared by all shapes, or (N, nPts, m)
+    Y: Input coordinates of shape (N, nPts, m)
+    scaling, reflection: See procrustes
+    Outputs:
+    d: (N,) residual sum of squared errors
+    Z: (N, nPts, m) transformed Y-values
+    tform: Dictionary of (N, m, m) rotations, (N,) scales and (N, m) translations
+    """
+    Y = np.asarray(Y, dtype='float')
+    X = np.asarray(X, dtype='float')
+    # A shared target is broadcast rather than copied for every shape
+    if X.ndim == 2:
+        X = X[None]
+
+    muX = X.mean(1, keepdims=True)
+    muY = Y.mean(1, keepdims=True)
+
+    X0 = X - muX
+    Y0 = Y - muY
+
+    ssX = (X0**2.).sum(axis=(1,2))
+    ssY = (Y0**2.).sum(axis=(1,2))
+
+    # centred Frobenius norm
+    normX = np.sqrt(ssX)
+    normY = np.sqrt(ssY)
+
+    # scale to equal (unit) norm
+    X0 = X0/normX[:,None,None]
+    Y0 = Y0/normY[:,None,None]
+
+    # optimum rotation matrix of each Y
+    A = np.matmul(X0.transpose(0,2,1), Y0)
+    U,s,Vt = np.linalg.svd(A,full_matrices=False)
+    V = Vt.transpose(0,2,1)
+    T = np.matmul(V, U.transpose(0,2,1))
+
+    if reflection != 'best':
+
+        # does the current solution use a reflection?
+        have_reflection = np.linalg.det(T) < 0
+
+        # if that's not what was specified, force another reflection
+        flip = have_reflection != reflection
+        V[flip,:,-1] *= -1
+        s[flip,-1] *= -1
+        T = np.matmul(V, U.transpose(0,2,1))
+
+    traceTA = s.sum(axis=1)
+
+    if scaling:
+
+        # optimum scaling of Y
+        b = traceTA * normX / normY
+
+        # standarised distance between X and b*Y*T + c
+        d = 1 - traceTA**2
+
+        # transformed coords
+        Z = (normX*traceTA)[:,None,None]*np.matmul(Y0, T) + muX
+
+    else:
+        b = np.ones(len(Y))
+        d = 1 + ssY/ssX - 2 * traceTA * normY / normX
+        Z = normY[:,None,None]*np.matmul(Y0, T) + muX
+
+    c = muX[:,0,:] - b[:,None]*np.matmul(muY, T)[:,0,:]
+
+    #transformation values
+    tform = {'rotation':T, 'scale':b, 'translation':c}
+
+    return d, Z, tform
+
+def alignPerimetersBatch(perims, referencePerim=None):
+    """
+    Aligns many interpolated perimeters at once, see alignPerimeters
+    Inputs:
+    perims: Array of interpolated perimeters of shape (N, nPts, 2)
+    referencePerim: Perimeter to align to, defaults to the first perimeter as in alignPerimeters
+    Outputs:
+    perimsAligned: (N, nPts, 2) perimeters aligned to the reference and centered at the origin
+    """
+    perims = np.asarray(perims, dtype='float')
+    if referencePerim is None:
+        referencePerim = perims[0]
+    referencePerim = referencePerim - np.mean(referencePerim, axis=0)
+
+    # Perform procrustes to align orientation (not scaled by size)
+    _, perimsAligned, _ = procrustesBatch(referencePerim, perims, scaling=False)
+
+    # Put cells centered at origin
+    perimsAligned = perimsAligned - np.mean(perimsAligned, axis=1, keepdims=True)
+    return perimsAligned
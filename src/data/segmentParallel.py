@@ -0,0 +1,185 @@
+"""
+Runs segmentExperiment over several processes. Image bases that are not yet segmented are
+sorted and dealt into nShards shards, each shard is segmented by its own process with its
+own predictor, and the shards are merged into the experiment's datasetShardLog. Images
+already in the log or in shards from an earlier run (with any nShards) are not segmented again.
+
+Example:
+python -m src.data.segmentParallel --dataPath ../data/TJ2201/split16 --experiment TJ2201 \
+    --modelPath ../models/TJ2201Split16 --nShards 4
+"""
+from src.data.segmentSingleCell import segmentExperiment, datasetShardLog
+from src.data.fileManagement import getImageBase
+from src.models import modelTools
+
+import os
+import json
+from pathlib import Path
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+def getShardName(experiment: str, shardNum: int, nShards: int):
+    """Name of the shard log written by one worker"""
+    return f'{experiment}-shard{shardNum}of{nShards}'
+
+def getShardNames(dataPath: str, experiment: str):
+    """
+    Finds the shard logs of every parallel run of an experiment, whatever its number of shards
+
+    Inputs:
+        - dataPath: Location of data
+        - experiment: Experiment from which images were gathered
+    Outputs:
+        - shardNames: Experiment names of the shard logs
+    """
+    suffix = 'DatasetDictShards'
+    shardDirs = Path(dataPath).glob(f'{experiment}-shard*of*{suffix}')
+    return sorted([shardDir.name[:-len(suffix)] for shardDir in shardDirs if shardDir.is_dir()])
+
+def getProcessedFiles(dataPath: str, experiment: str):
+    """
+    Gets the file names already segmented by the experiment's log or any of its shard logs
+
+    Inputs:
+        - dataPath: Location of data
+        - experiment: Experiment from which images were gathered
+    Outputs:
+        - processedFiles: Set of phase contrast file names
+    """
+    processedFiles = set(datasetShardLog(dataPath, experiment).processedFiles)
+    for shardName in getShardNames(dataPath, experiment):
+        processedFiles.update(datasetShardLog(dataPath, shardName).processedFiles)
+    return processedFiles
+
+def getShard(imgBases: list, shardNum: int, nShards: int):
+    """
+    Deterministically assigns image bases to a shard
+
+    Inputs:
+        - imgBases: All image bases of the experiment
+        - shardNum: Shard to get, from 0 to nShards-1
+        - nShards: Number of shards
+    Outputs:
+        - shard: Image bases belonging to the shard
+    """
+    return sorted(imgBases)[shardNum::nShards]
+
+def segmentShard(dataPath: str, imgBases: list, phenoDict: dict, experiment: str, modelPath: str,
+                 shardNum: int, nShards: int, nThreads: int, batchSize: int = 4, timeLimit = None, tileSize: int = None):
+    """
+    Segments one shard of an experiment in its own process
+
+    Inputs:
+        - dataPath, imgBases, phenoDict, experiment: See segmentExperiment
+        - modelPath: Folder with segmentation model, see modelTools.getSegmentModel
+        - shardNum: Shard to segment
+        - nShards: Number of shards
+        - nThreads: Number of threads torch may use in this process
+        - batchSize: Number of images passed through the model at once
+        - timeLimit: Seconds after which the shard stops, None to segment every image
+        - tileSize: Segment whole frames in overlapping tiles of this size, see segmentExperiment
+    Outputs:
+        - shardName: Experiment name of the shard log
+    """
+    torch.set_num_threads(nThreads)
+    predictor = modelTools.getSegmentModel(modelPath)
+    shardName = getShardName(experiment, shardNum, nShards)
+    shard = getShard(imgBases, shardNum, nShards)
+    print(f'Shard {shardNum}: {len(shard)} images with {nThreads} threads')
+    segmentExperiment(dataPath, shard, phenoDict, shardName, predictor,
+                      batchSize = batchSize, timeLimit = timeLimit, tileSize = tileSize)
+    return shardName
+
+def mergeShards(dataPath: str, experiment: str):
+    """
+    Adds records from every shard log to the experiment's datasetShardLog. Records already
+    in the log, including a datasetDict saved before the log existed, keep their image_id.
+    New records get the following image_ids in order of file name, so merging again does not
+    change any image_id.
+
+    Inputs:
+        - dataPath: Location of data
+        - experiment: Experiment from which images were gathered
+    Outputs:
+        - datasetDicts: All records of the experiment, also saved as {experiment}DatasetDict.npy
+    """
+    shardLog = datasetShardLog(dataPath, experiment)
+    shardNames = getShardNames(dataPath, experiment)
+    records = {}
+    for shardName in shardNames:
+        for record in datasetShardLog(dataPath, shardName).load():
+            fileName = os.path.basename(record['file_name'])
+            if fileName not in shardLog:
+                records[fileName] = record
+
+    for fileName in sorted(records.keys()):
+        record = records[fileName]
+        record['image_id'] = shardLog.nextImageId
+        shardLog.append(record)
+    datasetDicts = shardLog.consolidate()
+    print(f'Merged {len(records)} new images from {len(shardNames)} shards, {len(datasetDicts)} images in total')
+    return datasetDicts
+
+def segmentExperimentParallel(dataPath: str, imgBases: list, phenoDict: dict, experiment: str, modelPath: str,
+                              nShards: int = 4, nThreads: int = None, batchSize: int = 4, timeLimit = None, tileSize: int = None):
+    """
+    Segments an experiment with nShards processes then merges the shards. Images already
+    segmented by the experiment's log or by earlier shards are skipped.
+
+    Inputs:
+        - dataPath, imgBases, phenoDict, experiment: See segmentExperiment
+        - modelPath: Folder with segmentation model, see modelTools.getSegmentModel
+        - nShards: Number of worker processes
+        - nThreads: Threads per worker, defaults to splitting the CPU cores evenly
+        - batchSize: Number of images passed through the model at once
+        - timeLimit: Seconds after which each worker stops, None to segment every image
+        - tileSize: Segment whole frames in overlapping tiles of this size, see segmentExperiment
+    Outputs:
+        - datasetDicts: Merged records
+    """
+    processedFiles = getProcessedFiles(dataPath, experiment)
+    imgBases = [imgBase for imgBase in imgBases if f'phaseContrast_{imgBase}.png' not in processedFiles]
+    print(f'{len(processedFiles)} images already segmented, {len(imgBases)} left')
+    if nThreads is None:
+        nThreads = max(os.cpu_count() // nShards, 1)
+    # Spawn so that each worker starts its own torch and detectron2 state
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers = nShards, mp_context = context) as pool:
+        futures = [pool.submit(segmentShard, dataPath, imgBases, phenoDict, experiment, modelPath,
+                               shardNum, nShards, nThreads, batchSize, timeLimit, tileSize) for shardNum in range(nShards)]
+        for future in futures:
+            print(f'Finished {future.result()}')
+    return mergeShards(dataPath, experiment)
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segment an experiment with several processes')
+    parser.add_argument('--dataPath',   type = str, metavar='dataPath',   help = 'Folder holding phaseContrast and composite images', required = True)
+    parser.add_argument('--experiment', type = str, metavar='experiment', help = 'Experiment name', required = True)
+    parser.add_argument('--modelPath',  type = str, metavar='modelPath',  help = 'Folder with segmentation model', required = True)
+    parser.add_argument('--nShards',    type = int, metavar='nShards',    help = 'Number of worker processes', default = 4)
+    parser.add_argument('--nThreads',   type = int, metavar='nThreads',   help = 'Torch threads per worker', default = None)
+    parser.add_argument('--batchSize',  type = int, metavar='batchSize',  help = 'Images per forward pass', default = 4)
+    parser.add_argument('--timeLimit',  type = float, metavar='timeLimit', help = 'Seconds per worker before stopping, no limit if not given', default = None)
+    parser.add_argument('--tileSize',   type = int, metavar='tileSize',   help = 'Segment whole frames in overlapping tiles of this size', default = None)
+    parser.add_argument('--imgBases',   type = str, metavar='imgBases',   help = 'File with one image base per line, defaults to every phase contrast image', default = None)
+    parser.add_argument('--phenoDict',  type = str, metavar='phenoDict',  help = 'JSON connecting fluorescence to label', default = '{"green": 0, "red": 1}')
+    parser.add_argument('--mergeOnly',  action = 'store_true', help = 'Only merge existing shards, of any nShards')
+    args = parser.parse_args()
+
+    if args.imgBases is not None:
+        with open(args.imgBases, 'r') as imgBaseFile:
+            imgBases = [line.strip() for line in imgBaseFile if len(line.strip()) > 0]
+    else:
+        pcIms = os.listdir(os.path.join(args.dataPath, 'phaseContrast'))
+        imgBases = [getImageBase(pcIm) for pcIm in pcIms if pcIm.endswith('.png')]
+
+    if args.mergeOnly:
+        mergeShards(args.dataPath, args.experiment)
+    else:
+        segmentExperimentParallel(args.dataPath, imgBases, json.loads(args.phenoDict), args.experiment, args.modelPath,
+                                  nShards = args.nShards, nThreads = args.nThreads,
+                                  batchSize = args.batchSize, timeLimit = args.timeLimit, tileSize = args.tileSize)
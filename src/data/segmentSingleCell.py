@@ -15,7 +15,11 @@ from src.models import modelTools
 import time
 import pickle
 import os
+import json
 import shutil
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import random
@@ -64,124 +68,394 @@ def replaceDatasetDict(dataPath: str, experiment: str):
         print('Keeping dictionary')
         shutil.move(fullDict, modDict)
 
-
-def segmentExperiment(dataPath: str, imgBases: list, phenoDict: dict, experiment: str, predictor):
+def atomicWrite(path, writeFile):
     """
-    segmentExperiment gathers all segmentations for an experiment
+    Writes a file so that it is either completely written or not changed at all.
+    The file is written to a temporary file, synced to disk, then renamed over path.
 
     Inputs:
-        - dataPath: Location of data
-        - imgBases: The image bases specifying well, date, etc. of image
-        - phenoDict: Connects fluorescence to encoded label
-        - datasetDicts: Existing segmentations in Detectron format
-        - experiment: Experiment from which images were gathered
-        - predictor: Model trained for segmentation
-    Outputs:
-        - saved datasetDict
+        - path: Final location of the file
+        - writeFile: Function taking an open binary file object
     """
-    replaceDatasetDict(dataPath, experiment)
-    then = time.time()
-    # Load the dataset
-    datasetDictPath = os.path.join(dataPath, f'{experiment}DatasetDict.npy')
-    if os.path.isfile(datasetDictPath):
+    path = Path(path)
+    tmpPath = path.with_name(path.name + '.tmp')
+    with open(tmpPath, 'wb') as f:
+        writeFile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
+    # Sync the directory so the rename itself survives a crash
+    dirFd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dirFd)
+    finally:
+        os.close(dirFd)
+
+class datasetShardLog:
+    """
+    Append-only log of segmentation records. Records are buffered and written shardSize
+    at a time to their own shard, then the shard is added to a manifest. Each write is atomic,
+    so an interruption loses at most the records in the buffer.
+
+    Attributes
+    --------------------
+    - dataPath: Location of data
+    - experiment: Experiment from which images were gathered
+    - shardPath: Directory holding shards and manifest.json
+    - shardSize: Number of records per shard
+    - manifest: Names, sizes, and largest image_id of every written shard
+    - processedFiles: Set of phase contrast file names already segmented
+    - nextImageId: image_id of the next record
+    - buffer: Records not yet written to a shard
+    """
+    def __init__(self, dataPath: str, experiment: str, shardSize: int = 1000):
+        self.dataPath = dataPath
+        self.experiment = experiment
+        self.shardPath = Path(dataPath) / f'{experiment}DatasetDictShards'
+        self.shardPath.mkdir(parents=True, exist_ok=True)
+        self.manifestPath = self.shardPath / 'manifest.json'
+        self.shardSize = shardSize
+        self.buffer = []
+        self.processedFiles = set()
+        self.nextImageId = 0
+
+        if self.manifestPath.exists():
+            with open(self.manifestPath, 'r') as manifestFile:
+                self.manifest = json.load(manifestFile)
+        else:
+            self.manifest = {'shards': []}
+            self.migrateLegacy()
+
+        # Only the file names of each shard are read, records stay on disk
+        for shard in self.manifest['shards']:
+            with np.load(self.shardPath / shard['name']) as shardFile:
+                self.processedFiles.update(shardFile['files'].tolist())
+            if shard['nRecords'] > 0:
+                self.nextImageId = max(self.nextImageId, shard['maxImageId'] + 1)
+
+    def __contains__(self, fileName):
+        return os.path.basename(fileName) in self.processedFiles
+
+    def __len__(self):
+        return sum([shard['nRecords'] for shard in self.manifest['shards']]) + len(self.buffer)
+
+    def migrateLegacy(self):
+        """
+        Moves records saved by the alternating -0/-1 scheme into shards
+        """
+        replaceDatasetDict(self.dataPath, self.experiment)
+        datasetDictPath = os.path.join(self.dataPath, f'{self.experiment}DatasetDict.npy')
+        if not os.path.isfile(datasetDictPath):
+            return
         datasetDicts = list(np.load(datasetDictPath, allow_pickle=True))
-        idx = max([img['image_id'] for img in datasetDicts])+1
-    else:
+        print(f'Moving {len(datasetDicts)} saved images to shards')
+        for record in datasetDicts:
+            self.append(record)
+        self.flush()
+
+    def append(self, record: dict):
+        """
+        Adds a record, writing a shard when the buffer is full
+        """
+        self.buffer.append(record)
+        self.processedFiles.add(os.path.basename(record['file_name']))
+        self.nextImageId = max(self.nextImageId, record['image_id'] + 1)
+        if len(self.buffer) >= self.shardSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes buffered records to a new shard and adds it to the manifest
+        """
+        if len(self.buffer) == 0:
+            return
+        shardName = f"shard-{len(self.manifest['shards']):05d}.npz"
+        records = np.empty(len(self.buffer), dtype='object')
+        records[:] = self.buffer
+        files = np.array([os.path.basename(record['file_name']) for record in self.buffer], dtype='str')
+        atomicWrite(self.shardPath / shardName, lambda f: np.savez(f, records = records, files = files))
+
+        self.manifest['shards'].append({
+            'name': shardName,
+            'nRecords': len(self.buffer),
+            'maxImageId': int(max([record['image_id'] for record in self.buffer]))
+        })
+        manifest = json.dumps(self.manifest).encode()
+        atomicWrite(self.manifestPath, lambda f: f.write(manifest))
+        self.buffer = []
+
+    def load(self):
+        """
+        Reads every record in the log
+
+        Outputs:
+            - datasetDicts: Records with file names pointing to dataPath
+        """
         datasetDicts = []
-        idx = 0
-
-    if len(datasetDicts)>0:
+        for shard in self.manifest['shards']:
+            with np.load(self.shardPath / shard['name'], allow_pickle=True) as shardFile:
+                datasetDicts += list(shardFile['records'])
+        datasetDicts += self.buffer
         # Replace data path in case folder structure changes, etc.
-        for file in datasetDicts:
-            fileName = os.path.basename(file['file_name'])
+        for record in datasetDicts:
+            fileName = os.path.basename(record['file_name'])
             if 'phaseContrast' in fileName:
-                fileName = os.path.join(dataPath, 'phaseContrast', fileName)
-            file['file_name'] = fileName
-            if not os.path.isfile(fileName):
-                raise FileNotFoundError(f'{fileName} was not found, verify working directory')
+                record['file_name'] = os.path.join(self.dataPath, 'phaseContrast', fileName)
+        return datasetDicts
+
+    def consolidate(self):
+        """
+        Flushes the log and saves every record as a single datasetDict
+
+        Outputs:
+            - datasetDicts: All records in the log
+        """
+        self.flush()
+        datasetDicts = self.load()
+        datasetDictPath = os.path.join(self.dataPath, f'{self.experiment}DatasetDict.npy')
+        atomicWrite(datasetDictPath, lambda f: np.save(f, datasetDicts))
+        return datasetDicts
+
+def getAnnotationScores(datasetDicts: list):
+    """
+    Gets the detection score of every annotation in order. Annotations without a
+    score (e.g. manual segmentations) get infinity so they are never filtered.
 
-        processedFiles = [img['file_name'] for img in datasetDicts]
-        idx = max([img['image_id'] for img in datasetDicts])+1
-    else:
-        processedFiles = []
-        idx = 0
+    Inputs:
+        - datasetDicts: Segmentations in detectron2 format
+    Outputs:
+        - scores: Array of scores for each annotation
+        - nAnnotations: Number of annotations in each record
+    """
+    nAnnotations = np.array([len(record['annotations']) for record in datasetDicts], dtype='int64')
+    scores = np.array([annotation.get('score', np.inf) for record in datasetDicts \
+                                                       for annotation in record['annotations']], dtype='float64')
+    return scores, nAnnotations
+
+def filterDatasetDict(datasetDicts: list, scoreThresh: float, scores = None):
+    """
+    Keeps annotations with a detection score above scoreThresh. This is the same as
+    segmenting with a predictor using SCORE_THRESH_TEST = scoreThresh, as long as the
+    records were made with a lower threshold. Like detectron2, scores equal to the
+    threshold are dropped and the comparison is done in float32.
+
+    Inputs:
+        - datasetDicts: Segmentations in detectron2 format
+        - scoreThresh: Scores must be above this to be kept
+        - scores: Optional output of getAnnotationScores, saves recomputing it when sweeping thresholds
+    Outputs:
+        - datasetDictsFiltered: Copies of records with only the kept annotations
+    """
+    if scores is None:
+        scores = getAnnotationScores(datasetDicts)
+    scores, nAnnotations = scores
+    keepAll = np.split(scores.astype('float32') > np.float32(scoreThresh), np.cumsum(nAnnotations)[:-1])
+    datasetDictsFiltered = []
+    for record, keep in zip(datasetDicts, keepAll):
+        record = record.copy()
+        record['annotations'] = [annotation for annotation, k in zip(record['annotations'], keep) if k]
+        datasetDictsFiltered.append(record)
+    return datasetDictsFiltered
+
+def readImagePair(dataPath: str, imgBase: str):
+    """
+    Reads the phase contrast and composite images of an image base
 
-    saveIdx = 0
-    for imgBase in tqdm(imgBases, leave=True):
-        # Grab image
+    Inputs:
+        - dataPath: Location of data
+        - imgBase: The image base specifying well, date, etc. of image
+    Outputs:
+        - pcFileFull: Full path to the phase contrast image
+        - pcImg: Phase contrast image
+        - compositeImg: Composite fluorescence image
+    """
+    pcFileFull = os.path.join(dataPath, 'phaseContrast', f'phaseContrast_{imgBase}.png')
+    compositeFileFull = os.path.join(dataPath, 'composite', f'composite_{imgBase}.png')
+    pcImg = imread(pcFileFull)
+    compositeImg = imread(compositeFileFull)
+    return pcFileFull, pcImg, compositeImg
 
-        pcFile =        os.path.join('phaseContrast',f'phaseContrast_{imgBase}.png')
-        compositeFile = os.path.join('composite',f'composite_{imgBase}.png')
-        pcFileFull = os.path.join(dataPath, pcFile)
-        compositeFileFull = os.path.join(dataPath, compositeFile)
+def prefetchImagePairs(dataPath: str, imgBases: list, readPool, nPrefetch: int = 16):
+    """
+    Yields image pairs in order while a thread pool reads the next nPrefetch pairs
 
-        if pcFileFull in processedFiles:
+    Inputs:
+        - dataPath: Location of data
+        - imgBases: The image bases to read
+        - readPool: ThreadPoolExecutor used for reading
+        - nPrefetch: Number of pairs to read ahead
+    Outputs:
+        - Generator of (pcFileFull, pcImg, compositeImg)
+    """
+    pending = deque()
+    imgBases = iter(imgBases)
+    for imgBase in imgBases:
+        pending.append(readPool.submit(readImagePair, dataPath, imgBase))
+        if len(pending) >= nPrefetch:
+            break
+    while pending:
+        pair = pending.popleft().result()
+        for imgBase in imgBases:
+            pending.append(readPool.submit(readImagePair, dataPath, imgBase))
+            break
+        yield pair
+
+def getRecord(outputs, compositeImg, pcFileFull: str, imgShape, idx: int, phenoDict: dict, tolerance: float = 0, saveRLE: bool = False):
+    """
+    Converts the model output of one image to a record in detectron2 format
+
+    Inputs:
+        - outputs: Instances predicted for the image, on the CPU. Either full frame pred_masks
+          or cropped mask_crops and mask_offsets from modelTools.tiledPredict
+        - compositeImg: Composite fluorescence image
+        - pcFileFull: Full path to the phase contrast image
+        - imgShape: Shape of the phase contrast image
+        - idx: image_id of the record
+        - phenoDict: Connects fluorescence to encoded label
+        - tolerance: Polygon simplification tolerance in pixels, see mask2polygon
+        - saveRLE: Also save each mask as a run length encoding of its bounding box, see mask2rle
+    Outputs:
+        - record: Segmentations of red and green cells in the image
+    """
+    nCells = len(outputs)
+
+    # Go through each cell in each cropped image
+    record = {}
+    record['file_name'] = pcFileFull
+    record['image_id'] = idx
+    record['height'] = imgShape[0]
+    record['width'] =  imgShape[1]
+
+    boxes = outputs.pred_boxes.tensor.numpy()
+    scores = outputs.scores.numpy()
+    predClasses = outputs.pred_classes.numpy()
+    if outputs.has('mask_crops'):
+        masks = outputs.mask_crops
+        maskOffsets = outputs.mask_offsets.numpy()
+        colors = imageProcessing.findFluorescenceColors(compositeImg, masks, maskOffsets)
+    else:
+        masks = outputs.pred_masks.numpy()
+        maskOffsets = np.zeros((nCells, 2), dtype='int64')
+        colors = imageProcessing.findFluorescenceColors(compositeImg, masks)
+
+    cells = []
+    # Get segmentation outlines
+    for cellNum in range(nCells):
+        mask = masks[cellNum]
+        color = colors[cellNum]
+        if color not in ['red', 'green']:
+            continue
+        bbox = boxes[cellNum].tolist()
+        offset = maskOffsets[cellNum].tolist()
+        # Window of the box within the mask, which is the whole frame unless the mask is cropped
+        bboxMask = [bbox[0] - offset[1], bbox[1] - offset[0], bbox[2] - offset[1], bbox[3] - offset[0]]
+        poly = imageProcessing.mask2polygon(mask, bboxMask, tolerance, offset = offset)
+        if len(poly) == 0:
             continue
 
-        pcImg = imread(pcFileFull)
-        compositeImg = imread(compositeFileFull)
-
-        outputs = predictor(pcImg)['instances'].to("cpu")
-        nCells = len(outputs)
-
-
-        # Go through each cell in each cropped image
-        record = {}
-        record['file_name'] = pcFileFull
-        record['image_id'] = idx
-        record['height'] = pcImg.shape[0]
-        record['width'] =  pcImg.shape[1]
-
-        cells = []
-        # Get segmentation outlines
-        for cellNum in range(nCells):
-            mask = outputs[cellNum].pred_masks.numpy()[0]
-            color = imageProcessing.findFluorescenceColor(compositeImg, mask)
-            if color not in ['red', 'green']:
-                continue
-            contours = measure.find_contours(mask, .5)
-            fullContour = np.vstack(contours)
-
-            px = fullContour[:,1]
-            py = fullContour[:,0]
-            poly = [(x + 0.5, y + 0.5) for x, y in zip(px, py)]
-            poly = [p for x in poly for p in x]
-            
-            bbox = list(outputs[cellNum].pred_boxes.tensor.numpy()[0])
-
-            cell = {
-                "bbox": bbox,
-                "bbox_mode": BoxMode.XYXY_ABS,
-                "segmentation": [poly],
-                "category_id": phenoDict[color],
-            }
-
-            cells.append(cell)
-        record["annotations"] = cells
-        datasetDicts.append(record)
-        
+        cell = {
+            "bbox": bbox,
+            "bbox_mode": BoxMode.XYXY_ABS,
+            "segmentation": [poly],
+            "category_id": phenoDict[color],
+            "score": float(scores[cellNum]),
+            "pred_class": int(predClasses[cellNum]),
+        }
+        if saveRLE:
+            cell["maskRLE"] = imageProcessing.mask2rle(mask, bboxMask, offset = offset)
+
+        cells.append(cell)
+    record["annotations"] = cells
+    return record
+
+def getRecords(batch: list, outputs: list, idx: int, phenoDict: dict, tolerance: float = 0, saveRLE: bool = False):
+    """
+    Converts the model output of a batch of images to records, see getRecord
+    """
+    records = []
+    for (pcFileFull, pcImg, compositeImg), output in zip(batch, outputs):
+        instances = output['instances'].to('cpu')
+        records.append(getRecord(instances, compositeImg, pcFileFull, pcImg.shape, idx, phenoDict, tolerance, saveRLE))
         idx += 1
+    return records
 
-        # Alternate saving so that if saving gets interrupted we lose < 1000 images
-        if idx % 1000 == 0:
-            modIdx = saveIdx % 2
-            datasetDictPath = os.path.join(dataPath, f'{experiment}DatasetDict-{modIdx}.npy')
-            picklePath = os.path.join(dataPath, f'{experiment}DatasetDict-{modIdx}.pickle')
-            print(f'Saving {len(datasetDicts)} images')
-            np.save(datasetDictPath, datasetDicts)
-            # pickle.dump(datasetDicts, open(picklePath, "wb"))
-            print('Done saving')
-            saveIdx += 1
-
-        # If time running > 8 hours stop (28800 seconds)
-        if time.time()-then > 72247:
-            print('Time is up!')
-            datasetDictPath = os.path.join(dataPath, f'{experiment}DatasetDict.npy')
-            np.save(datasetDictPath, datasetDicts)            
-            
-            year, month, day, hour, min = map(int, time.strftime("%Y %m %d %H %M").split())
-            print(f'Finished on {month}-{day}-{year} at {hour}:{min}')
-            break
+def segmentExperiment(dataPath: str, imgBases: list, phenoDict: dict, experiment: str, predictor, batchSize: int = 4, nReaders: int = 4, shardSize: int = 1000, tolerance: float = 0, timeLimit = 72247, tileSize: int = None, tileOverlap: int = 128, saveRLE: bool = False):
+    """
+    segmentExperiment gathers all segmentations for an experiment
+
+    Images are read ahead by a pool of nReaders threads and passed through the model
+    batchSize at a time. Records for one batch are made while the next batch is predicted.
+    Records are saved shardSize at a time to the datasetShardLog in
+    {experiment}DatasetDictShards. A run that stops early (time limit, crash) resumes from
+    the log: every image already in it is skipped and new records continue its image_ids.
+    A {experiment}DatasetDict.npy from before the log existed is moved into it first.
+
+    Inputs:
+        - dataPath: Location of data
+        - imgBases: The image bases specifying well, date, etc. of image
+        - phenoDict: Connects fluorescence to encoded label
+        - experiment: Experiment from which images were gathered, names the shard log
+        - predictor: Model trained for segmentation
+        - batchSize: Number of images passed through the model at once
+        - nReaders: Number of threads reading images
+        - shardSize: Number of records per saved shard
+        - tolerance: Polygon simplification tolerance in pixels, 0 keeps every contour vertex
+        - timeLimit: Seconds after which segmentation stops, None to segment every image
+        - tileSize: If given, dataPath holds whole frames which are segmented in overlapping
+          tiles of this size with modelTools.tiledPredict, see tileOverlap
+        - tileOverlap: Minimum overlap between tiles
+        - saveRLE: Also save each mask as a run length encoding in annotation['maskRLE']
+    Outputs:
+        - Every record in the log, saved as {experiment}DatasetDict.npy
+    """
+    then = time.time()
+    # Load the records segmented so far
+    shardLog = datasetShardLog(dataPath, experiment, shardSize)
+    idx = shardLog.nextImageId
+    imgBases = [imgBase for imgBase in imgBases if f'phaseContrast_{imgBase}.png' not in shardLog]
+
+    nSegmented = 0
+    timeUp = False
+    readPool = ThreadPoolExecutor(max_workers = nReaders)
+    postPool = ThreadPoolExecutor(max_workers = 1)
+    imagePairs = prefetchImagePairs(dataPath, imgBases, readPool, nPrefetch = 2*batchSize*nReaders)
+    pendingRecords = None
+    pbar = tqdm(total = len(imgBases), leave=True)
+    try:
+        while not timeUp:
+            batch = [pair for _, pair in zip(range(batchSize), imagePairs)]
+            if len(batch) > 0:
+                if tileSize is None:
+                    outputs = modelTools.batchPredict(predictor, [pcImg for _, pcImg, _ in batch])
+                else:
+                    outputs = [modelTools.tiledPredict(predictor, pcImg, tileSize, tileOverlap, batchSize) for _, pcImg, _ in batch]
+            # Finish records of the previous batch while this one was predicted
+            if pendingRecords is not None:
+                for record in pendingRecords.result():
+                    shardLog.append(record)
+                    idx += 1
+                    nSegmented += 1
+                    pbar.update(1)
+                pendingRecords = None
+
+                # Stop once the time limit is reached, the shard log keeps progress for the next run
+                if timeLimit is not None and time.time()-then > timeLimit:
+                    print(f'Time is up! {len(imgBases) - nSegmented} images were not segmented')
+                    year, month, day, hour, min = map(int, time.strftime("%Y %m %d %H %M").split())
+                    print(f'Finished on {month}-{day}-{year} at {hour}:{min}')
+                    timeUp = True
+                    break
+            if len(batch) == 0:
+                break
+            pendingRecords = postPool.submit(getRecords, batch, outputs, idx, phenoDict, tolerance, saveRLE)
+    finally:
+        pbar.close()
+        readPool.shutdown(wait = False, cancel_futures = True)
+        postPool.shutdown(wait = True)
+    print(f'Segmented {nSegmented} images at {nSegmented/(time.time()-then):0.2f} images/s')
+    print(f'Saving {len(shardLog)} images')
+    shardLog.consolidate()
+    print('Done saving')
 
 
 # %%
@@ -4,7 +4,7 @@ This file stores segmentation tools
 """
 
 # %%
-from src.data.imageProcessing import imSplit
+from src.data.imageProcessing import imSplit, mask2polygon
 from src.data.fileManagement import getImageBase
 
 import numpy as np
@@ -14,11 +14,12 @@ from tqdm import tqdm
 
 from skimage import measure
 from skimage import img_as_float
+from scipy import ndimage
 
 from detectron2.data import MetadataCatalog, DatasetCatalog
 from detectron2.structures import BoxMode
 # %%
-def cellpose2Detectron(experiment, imgType='phaseContrast', stage=None):
+def cellpose2Detectron(experiment, imgType='phaseContrast', stage=None, tolerance=0):
     """
     Takes cellpose output data and converts it into Detectron2 format
 
@@ -26,6 +27,7 @@ def cellpose2Detectron(experiment, imgType='phaseContrast', stage=None):
         - experiment: Name of experiment that was manually segmented
         - imgType: Name of folder containing images (phaseContrast, composite, etc.)
         - stage: Flag for making training or testing sets
+        - tolerance: Polygon simplification tolerance in pixels, see mask2polygon
     
     Outputs:
         - datasetDicts: Detectron2 segmentation format
@@ -79,21 +81,20 @@ def cellpose2Detectron(experiment, imgType='phaseContrast', stage=None):
             record['width'] = splitMasks[splitNum-1].shape[1]
 
             mask = splitMasks[splitNum-1]
-            cellNums = np.unique(mask)
-            cellNums = cellNums[cellNums != 0]
+            cellSlices = ndimage.find_objects(mask)
 
             cells = []
             # For each cell, convert to a polygon representation
-            for cellNum in cellNums:
-                contours = measure.find_contours(img_as_float(mask==cellNum), .5)
-                fullContour = np.vstack(contours)
-
-                px = fullContour[:,1]
-                py = fullContour[:,0]
-                poly = [(x + 0.5, y + 0.5) for x, y in zip(px, py)]
-                poly = [p for x in poly for p in x]
+            for cellNum, cellSlice in enumerate(cellSlices, start=1):
+                if cellSlice is None:
+                    continue
+                # Only compare labels within the cell's bounding box plus a 1 pixel border
+                rowStart, colStart = max(cellSlice[0].start - 1, 0), max(cellSlice[1].start - 1, 0)
+                cellMask = mask[rowStart:cellSlice[0].stop + 1, colStart:cellSlice[1].stop + 1] == cellNum
+                poly = mask2polygon(cellMask, tolerance = tolerance, offset = (rowStart, colStart))
                 # if len(poly) < 4:
                 #     return
+                px, py = np.array(poly[0::2]) - 0.5, np.array(poly[1::2]) - 0.5
                 cell = {
                     "bbox": [np.min(px), np.min(py), np.max(px), np.max(py)],
                     "bbox_mode": BoxMode.XYXY_ABS,
@@ -0,0 +1,262 @@
+"""
+Extracts pyfeats texture features (see imageProcessing.extractFeatures) for every cell of a
+datasetDict. Cells are grouped by frame so each frame is read once, frames are spread over
+a process pool, and each feature family is saved to its own folder of append-only chunk
+files keyed by (image_id, annotation index). Families and cells that were already extracted
+are skipped.
+
+Example:
+python -m src.features.textureFeatures --datasetDict ../data/TJ2201/TJ2201DatasetDict.npy \
+    --imageRoot ../data/TJ2201/split16/phaseContrast --savePath ../data/TJ2201/textureFeatures \
+    --families A_FOS A_GLCM
+"""
+import os
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from skimage.io import imread
+from skimage.draw import polygon
+
+from src.data.imageProcessing import featureFamilies, flattenFeatures, importPyfeats
+
+def getCellImage(img, annotation):
+    """
+    Crops a cell to its bounding box
+
+    Inputs:
+        - img: Grayscale frame the cell was segmented in
+        - annotation: Annotation in datasetDict format
+    Outputs:
+        - image: Cropped image
+        - mask: Mask of ints where the cell is located
+        - perim: Polygon of the cell as (x, y) points in crop coordinates
+    """
+    colMin, rowMin, colMax, rowMax = [int(corner) for corner in annotation['bbox']]
+    rowMin, colMin = max(rowMin, 0), max(colMin, 0)
+    rowMax, colMax = min(rowMax + 1, img.shape[0]), min(colMax + 1, img.shape[1])
+    image = img[rowMin:rowMax, colMin:colMax]
+
+    poly = np.array(annotation['segmentation'][0]).reshape(-1, 2)
+    perim = poly - [colMin, rowMin]
+    mask = np.zeros(image.shape, dtype='int')
+    rr, cc = polygon(perim[:, 1], perim[:, 0], image.shape)
+    mask[rr, cc] = 1
+    return image, mask, perim
+
+def extractFrameFeatures(imgPath: str, annotations: dict, families: list):
+    """
+    Extracts features for cells of one frame, run in a worker process. A family failing
+    on a cell (e.g. a crop too small for its filters) only loses that cell's features.
+
+    Inputs:
+        - imgPath: Location of the frame
+        - annotations: Dictionary of family and list of (annotation index, annotation) missing for it
+        - families: Families to extract, in order
+    Outputs:
+        - frameFeatures: Dictionary of family and (annotation indices, features, labels, seconds).
+          Features are None for cells where the family failed, labels are None if it failed on every cell
+    """
+    img = imread(imgPath)
+    if img.ndim == 3:
+        img = img[:, :, 0]
+
+    cells = {}
+    frameFeatures = {}
+    for family in families:
+        annIdxs, features, labels = [], [], None
+        then = time.time()
+        for annIdx, annotation in annotations[family]:
+            annIdxs.append(annIdx)
+            try:
+                if annIdx not in cells:
+                    cells[annIdx] = getCellImage(img, annotation)
+                image, mask, perim = cells[annIdx]
+                cellFeatures, labels = flattenFeatures(featureFamilies[family](image, mask, perim))
+                features.append(np.array(cellFeatures, dtype='float64'))
+            except Exception as e:
+                print(f'{family} failed on cell {annIdx} of {os.path.basename(imgPath)}: {e}')
+                features.append(None)
+        frameFeatures[family] = (annIdxs, features, labels, time.time() - then)
+    return frameFeatures
+
+def getFamilyPath(savePath: str, family: str):
+    """Location of the folder holding the chunk files of one feature family"""
+    return os.path.join(savePath, family)
+
+def loadFamily(savePath: str, family: str):
+    """
+    Loads one feature family by joining its chunk files
+
+    Inputs:
+        - savePath: Folder of feature files
+        - family: Feature family
+    Outputs:
+        - imageIds: image_id of each row
+        - annIdxs: Annotation index of each row
+        - features: Array of shape (rows, features)
+        - labels: Name of each feature column
+    """
+    familyPath = getFamilyPath(savePath, family)
+    chunkPaths = sorted(glob.glob(os.path.join(familyPath, 'chunk*.npz')))
+    if len(chunkPaths) == 0:
+        return np.zeros(0, dtype='int'), np.zeros(0, dtype='int'), np.zeros((0, 0)), []
+    imageIds, annIdxs, features = [], [], []
+    for chunkPath in chunkPaths:
+        with np.load(chunkPath) as familyFile:
+            imageIds.append(familyFile['imageIds'])
+            annIdxs.append(familyFile['annIdxs'])
+            features.append(familyFile['features'])
+            labels = list(familyFile['labels'])
+    imageIds, annIdxs, features = np.concatenate(imageIds), np.concatenate(annIdxs), np.concatenate(features)
+    order = np.lexsort((annIdxs, imageIds))
+    return imageIds[order], annIdxs[order], features[order], labels
+
+def saveFamily(savePath: str, family: str, imageIds, annIdxs, features, labels):
+    """Writes new rows of one feature family as its next chunk file, earlier chunks are not touched"""
+    familyPath = getFamilyPath(savePath, family)
+    os.makedirs(familyPath, exist_ok=True)
+    nChunks = len(glob.glob(os.path.join(familyPath, 'chunk*.npz')))
+    chunkPath = os.path.join(familyPath, f'chunk{nChunks:05d}.npz')
+    tmpPath = chunkPath + '.tmp'
+    with open(tmpPath, 'wb') as familyFile:
+        np.savez(familyFile, imageIds=imageIds, annIdxs=annIdxs,
+                 features=features, labels=np.array(labels, dtype='str'))
+    os.replace(tmpPath, chunkPath)
+
+def extractDatasetFeatures(datasetDicts: list, imageRoot: str, savePath: str, families: list = None,
+                           nWorkers: int = None, saveEvery: int = 100):
+    """
+    Extracts texture features for every cell of a datasetDict. Only (family, cell) pairs
+    missing from savePath are computed. Cells where a family fails are saved as nan and
+    not tried again.
+
+    Inputs:
+        - datasetDicts: Records with annotations, image_id, and file_name
+        - imageRoot: Folder with the images, file names are taken from file_name
+        - savePath: Folder where each family is saved as chunk files in {family}/
+        - families: Keys of imageProcessing.featureFamilies to extract, defaults to all
+        - nWorkers: Number of worker processes, defaults to the number of CPU cores
+        - saveEvery: Number of finished frames between saves, so a crash loses at most this many
+    Outputs:
+        - familyTimes: Dictionary of family and seconds spent on it summed over workers
+    """
+    importPyfeats()
+    if families is None:
+        families = list(featureFamilies.keys())
+    for family in families:
+        if family not in featureFamilies:
+            raise ValueError(f'Unknown feature family {family}, choose from {list(featureFamilies.keys())}')
+    os.makedirs(savePath, exist_ok=True)
+
+    done = {}
+    labels = {}
+    for family in families:
+        imageIds, annIdxs, _, labels[family] = loadFamily(savePath, family)
+        done[family] = set(zip(imageIds.tolist(), annIdxs.tolist()))
+
+    # Group missing cells by frame
+    frames = []
+    for record in datasetDicts:
+        imageId = record['image_id']
+        missing = {family: [(annIdx, annotation) for annIdx, annotation in enumerate(record['annotations'])
+                            if (imageId, annIdx) not in done[family]]
+                   for family in families}
+        if sum(len(cells) for cells in missing.values()) > 0:
+            imgPath = os.path.join(imageRoot, os.path.basename(record['file_name']))
+            frames.append((imageId, imgPath, missing))
+    print(f'Extracting features from {len(frames)} frames')
+
+    pending = {family: [] for family in families}
+    familyTimes = {family: 0 for family in families}
+    nFailed = {family: 0 for family in families}
+
+    def saveFinished():
+        """Saves finished rows of every family with known labels as a new chunk"""
+        for family in families:
+            if len(pending[family]) == 0 or len(labels[family]) == 0:
+                continue
+            features = np.full((len(pending[family]), len(labels[family])), np.nan)
+            for row, (imageId, annIdx, cellFeatures) in enumerate(pending[family]):
+                if cellFeatures is not None and len(cellFeatures) == len(labels[family]):
+                    features[row] = cellFeatures
+            imageIds = np.array([row[0] for row in pending[family]], dtype='int')
+            annIdxs = np.array([row[1] for row in pending[family]], dtype='int')
+            saveFamily(savePath, family, imageIds, annIdxs, features, labels[family])
+            pending[family] = []
+
+    if len(frames) > 0:
+        if nWorkers is None:
+            nWorkers = os.cpu_count()
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers = nWorkers, mp_context = context) as pool:
+            futures = {pool.submit(extractFrameFeatures, imgPath, missing, families): (imageId, imgPath) \
+                       for imageId, imgPath, missing in frames}
+            try:
+                for nFinished, future in enumerate(as_completed(futures), start = 1):
+                    imageId, imgPath = futures[future]
+                    try:
+                        frameFeatures = future.result()
+                    except Exception as e:
+                        print(f'Could not extract features from {imgPath}: {e}')
+                        continue
+                    for family, (annIdxs, features, familyLabels, seconds) in frameFeatures.items():
+                        pending[family] += [(imageId, annIdx, cellFeatures) for annIdx, cellFeatures in zip(annIdxs, features)]
+                        nFailed[family] += sum([cellFeatures is None for cellFeatures in features])
+                        familyTimes[family] += seconds
+                        if familyLabels is not None and len(labels[family]) == 0:
+                            labels[family] = familyLabels
+                    if nFinished % saveEvery == 0:
+                        saveFinished()
+            finally:
+                saveFinished()
+
+    for family in families:
+        print(f'{family}: {familyTimes[family]:0.2f} s, {nFailed[family]} cells failed')
+        if len(pending[family]) > 0:
+            print(f'{family} failed on every cell, {len(pending[family])} cells will be tried again')
+    return familyTimes
+
+def loadFeatures(savePath: str, datasetDicts: list, families: list):
+    """
+    Joins feature families into one table with a row per cell of datasetDicts
+
+    Inputs:
+        - savePath: Folder of feature files
+        - datasetDicts: Records defining the rows, in order of image then annotation
+        - families: Families to join
+    Outputs:
+        - keys: Array of (image_id, annotation index) for each row
+        - features: Array of shape (cells, features), nan where a cell was not extracted
+        - labels: Name of each feature column prefixed by its family
+    """
+    keys = np.array([(record['image_id'], annIdx) for record in datasetDicts
+                     for annIdx in range(len(record['annotations']))], dtype='int').reshape(-1, 2)
+    rows = {(imageId, annIdx): row for row, (imageId, annIdx) in enumerate(keys.tolist())}
+    allFeatures, allLabels = [], []
+    for family in families:
+        imageIds, annIdxs, features, labels = loadFamily(savePath, family)
+        familyFeatures = np.full((len(keys), len(labels)), np.nan)
+        for imageId, annIdx, cellFeatures in zip(imageIds.tolist(), annIdxs.tolist(), features):
+            if (imageId, annIdx) in rows:
+                familyFeatures[rows[(imageId, annIdx)]] = cellFeatures
+        allFeatures.append(familyFeatures)
+        allLabels += [f'{family}_{label}' for label in labels]
+    return keys, np.concatenate(allFeatures, axis=1), allLabels
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract texture features for every cell of a datasetDict')
+    parser.add_argument('--datasetDict', type = str, metavar='datasetDict', help = 'Saved datasetDict (.npy)', required = True)
+    parser.add_argument('--imageRoot',   type = str, metavar='imageRoot',   help = 'Folder with the segmented images', required = True)
+    parser.add_argument('--savePath',    type = str, metavar='savePath',    help = 'Folder for feature files', required = True)
+    parser.add_argument('--families',    type = str, nargs = '+',           help = 'Feature families to extract, defaults to all', default = None)
+    parser.add_argument('--nWorkers',    type = int, metavar='nWorkers',    help = 'Number of worker processes', default = None)
+    parser.add_argument('--saveEvery',   type = int, metavar='saveEvery',   help = 'Number of finished frames between saves', default = 100)
+    args = parser.parse_args()
+
+    datasetDicts = np.load(args.datasetDict, allow_pickle=True)
+    extractDatasetFeatures(datasetDicts, args.imageRoot, args.savePath, args.families, args.nWorkers, args.saveEvery)
@@ -0,0 +1,209 @@
+"""
+Exports a trained Mask R-CNN to a standalone TorchScript or ONNX file and runs it
+without building the detectron2 model from a config.
+
+Example:
+python -m src.models.exportModel --modelPath ../models/segmentation/TJ2201Split16 \
+    --image ../data/TJ2201/split16/phaseContrast/phaseContrast_C4_4_2022y04m06d_12h00m_14.png
+"""
+from src.models.modelTools import getSegmentConfig, getSegmentModelPath
+
+import json
+import time
+import pickle
+import argparse
+import numpy as np
+from pathlib import Path
+from skimage.io import imread
+
+import torch
+from detectron2.modeling import build_model
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.export import TracingAdapter
+from detectron2.modeling.postprocessing import detector_postprocess
+import detectron2.data.transforms as T
+
+def exportSegmentModel(modelPath: str, sampleImg, exportFormat: str = 'torchscript', confidenceThresh = 0.7, numClasses = 1):
+    """
+    Traces a trained segmentation model on the CPU and saves it next to model_final.pth.
+    The score threshold is part of the traced model.
+
+    Inputs:
+        - modelPath: Folder with model_final.pth, see modelTools.getSegmentModel
+        - sampleImg: Image with cells used for tracing, in BGR order as passed to DefaultPredictor
+        - exportFormat: 'torchscript' or 'onnx'
+        - confidenceThresh: Lowest score of returned instances
+        - numClasses: Number of classes of the model
+    Outputs:
+        - exportPath: Location of the exported model. Its output schema and preprocessing
+          settings are saved in the same folder as exportSchema.pkl and exportInfo.json
+    """
+    cfg = getSegmentConfig(modelPath, numClasses, confidenceThresh)
+    cfg.MODEL.DEVICE = 'cpu'
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    aug = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+    if cfg.INPUT.FORMAT == 'RGB':
+        sampleImg = sampleImg[:, :, ::-1]
+    image = aug.get_transform(sampleImg).apply_image(sampleImg)
+    image = torch.as_tensor(image.astype('float32').transpose(2, 0, 1))
+
+    # Without postprocessing the outputs are in resized image coordinates with small masks,
+    # detector_postprocess pastes them into the original image after running the export
+    adapter = TracingAdapter(model, [{'image': image}], lambda model, inputs: model.inference(inputs, do_postprocess=False))
+    exportDir = Path(cfg.OUTPUT_DIR)
+    if exportFormat == 'torchscript':
+        exportPath = exportDir / 'model.ts'
+        with torch.no_grad():
+            traced = torch.jit.trace(adapter, adapter.flattened_inputs)
+        traced.save(str(exportPath))
+    elif exportFormat == 'onnx':
+        exportPath = exportDir / 'model.onnx'
+        with torch.no_grad():
+            torch.onnx.export(adapter, adapter.flattened_inputs, str(exportPath), opset_version=16,
+                              input_names=['image'], dynamic_axes={'image': {1: 'height', 2: 'width'}})
+    else:
+        raise ValueError(f'Export format must be torchscript or onnx, not {exportFormat}')
+
+    with open(exportDir / 'exportSchema.pkl', 'wb') as schemaFile:
+        pickle.dump(adapter.outputs_schema, schemaFile)
+    exportInfo = {
+        'format': exportFormat,
+        'file': exportPath.name,
+        'inputFormat': cfg.INPUT.FORMAT,
+        'minSizeTest': cfg.INPUT.MIN_SIZE_TEST,
+        'maxSizeTest': cfg.INPUT.MAX_SIZE_TEST,
+        'confidenceThresh': confidenceThresh,
+        'numClasses': numClasses
+    }
+    with open(exportDir / 'exportInfo.json', 'w') as infoFile:
+        json.dump(exportInfo, infoFile)
+    print(f'Saved {exportFormat} model to {exportPath}')
+    return exportPath
+
+class exportedModel:
+    """
+    Runs an exported model on a list of inputs like a detectron2 model does in inference
+
+    Attributes
+    --------------------
+    - exportFormat: 'torchscript' or 'onnx'
+    - runtime: Loaded TorchScript module or ONNX Runtime session
+    - outputsSchema: Schema rebuilding Instances from the flattened outputs
+    """
+    def __init__(self, exportPath: str, exportFormat: str, outputsSchema):
+        self.exportFormat = exportFormat
+        self.outputsSchema = outputsSchema
+        if exportFormat == 'torchscript':
+            self.runtime = torch.jit.load(str(exportPath), map_location='cpu')
+            self.runtime.eval()
+        else:
+            import onnxruntime
+            self.runtime = onnxruntime.InferenceSession(str(exportPath), providers=['CPUExecutionProvider'])
+
+    def __call__(self, inputs: list):
+        outputs = []
+        for modelInput in inputs:
+            if self.exportFormat == 'torchscript':
+                with torch.no_grad():
+                    flatOutputs = self.runtime(modelInput['image'])
+            else:
+                flatOutputs = self.runtime.run(None, {'image': modelInput['image'].numpy()})
+                flatOutputs = [torch.from_numpy(flatOutput) for flatOutput in flatOutputs]
+            instances = self.outputsSchema(flatOutputs)[0]
+            instances = detector_postprocess(instances, modelInput['height'], modelInput['width'])
+            outputs.append({'instances': instances})
+        return outputs
+
+class exportedPredictor:
+    """
+    Drop-in replacement for DefaultPredictor using a model from exportSegmentModel.
+    It also works with modelTools.batchPredict and segmentExperiment.
+
+    Attributes
+    --------------------
+    - model: exportedModel
+    - aug: Resizing applied before the model
+    - input_format: Channel order expected by the model
+    - exportInfo: Settings saved when exporting
+    """
+    def __init__(self, modelPath: str):
+        modelPath = Path(getSegmentModelPath(modelPath))
+        with open(modelPath / 'exportInfo.json', 'r') as infoFile:
+            self.exportInfo = json.load(infoFile)
+        with open(modelPath / 'exportSchema.pkl', 'rb') as schemaFile:
+            outputsSchema = pickle.load(schemaFile)
+        self.model = exportedModel(modelPath / self.exportInfo['file'], self.exportInfo['format'], outputsSchema)
+        self.aug = T.ResizeShortestEdge([self.exportInfo['minSizeTest'], self.exportInfo['minSizeTest']], self.exportInfo['maxSizeTest'])
+        self.input_format = self.exportInfo['inputFormat']
+
+    def __call__(self, original_image):
+        if self.input_format == 'RGB':
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype('float32').transpose(2, 0, 1))
+        return self.model([{'image': image, 'height': height, 'width': width}])[0]
+
+def checkExportParity(predictor, exported, imgs: list, atol = 1e-3):
+    """
+    Compares instances from DefaultPredictor and an exportedPredictor
+
+    Inputs:
+        - predictor: DefaultPredictor of the same model
+        - exported: exportedPredictor
+        - imgs: Images to compare on
+        - atol: Largest allowed difference in boxes (pixels) and scores
+    Outputs:
+        - matches: True if every image has the same instances, masks may differ on a few edge pixels
+    """
+    matches = True
+    for n, img in enumerate(imgs):
+        expected = predictor(img)['instances'].to('cpu')
+        actual = exported(img)['instances'].to('cpu')
+        if len(expected) != len(actual):
+            print(f'Image {n}: {len(expected)} instances expected, {len(actual)} exported')
+            matches = False
+            continue
+        if len(expected) == 0:
+            continue
+        boxDiff = float((expected.pred_boxes.tensor - actual.pred_boxes.tensor).abs().max())
+        scoreDiff = float((expected.scores - actual.scores).abs().max())
+        maskDiff = float((expected.pred_masks != actual.pred_masks).float().mean())
+        print(f'Image {n}: box difference {boxDiff:0.2e}, score difference {scoreDiff:0.2e}, mask pixels differing {maskDiff:0.2e}')
+        if boxDiff > atol or scoreDiff > atol or maskDiff > 1e-3:
+            matches = False
+    return matches
+
+def benchmarkPredictors(predictors: dict, imgs: list):
+    """
+    Prints images/s of each predictor
+
+    Inputs:
+        - predictors: Dictionary of name and predictor
+        - imgs: Images to predict
+    """
+    for name, predictor in predictors.items():
+        # Warm up
+        predictor(imgs[0])
+        then = time.time()
+        for img in imgs:
+            predictor(img)
+        elapsed = time.time() - then
+        print(f'{name}: {len(imgs)/elapsed:0.2f} images/s')
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a segmentation model')
+    parser.add_argument('--modelPath',        type = str,   metavar='modelPath',        help = 'Folder with model_final.pth', required = True)
+    parser.add_argument('--image',            type = str,   metavar='image',            help = 'Phase contrast image used for tracing', required = True)
+    parser.add_argument('--format',           type = str,   metavar='format',           help = 'torchscript or onnx', default = 'torchscript')
+    parser.add_argument('--confidenceThresh', type = float, metavar='confidenceThresh', help = 'Lowest score of returned instances', default = 0.7)
+    args = parser.parse_args()
+
+    img = imread(args.image)
+    if img.ndim == 2:
+        img = np.array([img, img, img]).transpose([1, 2, 0])
+    exportSegmentModel(args.modelPath, img, args.format, args.confidenceThresh)
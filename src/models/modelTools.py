@@ -4,6 +4,7 @@ from skimage.io import imread
 import matplotlib.pyplot as plt
 import torch
 import os
+import numpy as np
 import time
 from pathlib import Path
 # from centermask.config import get_cfg
@@ -13,24 +14,26 @@ from detectron2.engine import DefaultPredictor
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer
 from detectron2.data import MetadataCatalog, DatasetCatalog
-from detectron2.structures import BoxMode
+from detectron2.structures import BoxMode, Boxes, Instances
 from detectron2.utils.visualizer import ColorMode
 
-def getSegmentModel(modelPath: str, numClasses = 1):
+def getSegmentModelPath(modelPath: str):
     """
-    Gets a segmentation model that can be used to output masks
-    Inputs:
-    modelPath: Folder with model. Final model must be named model_final.pth
-    Outputs:
-    Mask-RCNN model
+    Inserts the segmentation folder into a model path if it is missing
     """
-    # Insert segmentation folder to correctly load path
     modelPath = Path(modelPath)
     if modelPath.parts[-2] != 'segmentation':
         modelPathParts = list(modelPath.parts)
         modelPathParts.insert(-1, 'segmentation')
         modelPath = Path(*modelPathParts)
-    modelPath = str(modelPath)
+    return str(modelPath)
+
+def getSegmentConfig(modelPath: str, numClasses = 1, confidenceThresh = 0.7):
+    """
+    Gets the detectron2 config of a trained segmentation model, see getSegmentModel
+    """
+    # Insert segmentation folder to correctly load path
+    modelPath = getSegmentModelPath(modelPath)
     cfg = get_cfg()
     if not torch.cuda.is_available():
         print('CUDA not available, resorting to CPU')
@@ -48,11 +51,199 @@ def getSegmentModel(modelPath: str, numClasses = 1):
     cfg.MODEL.ROI_HEADS.NUM_CLASSES = numClasses
     cfg.OUTPUT_DIR = modelPath
     cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model_final.pth")  # path to the model we just trained
-    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.7   # set a custom testing threshold
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = confidenceThresh   # set a custom testing threshold
+    return cfg
+
+def getSegmentModel(modelPath: str, numClasses = 1, confidenceThresh = 0.7):
+    """
+    Gets a segmentation model that can be used to output masks
+    Inputs:
+    modelPath: Folder with model. Final model must be named model_final.pth
+    confidenceThresh: Lowest score of returned instances. Use a low value to save every detection
+    once and filter afterwards with segmentSingleCell.filterDatasetDict
+    Outputs:
+    Mask-RCNN model
+    """
+    cfg = getSegmentConfig(modelPath, numClasses, confidenceThresh)
     predictor = DefaultPredictor(cfg)
 
     return predictor
 
+def batchPredict(predictor, imgs: list):
+    """
+    Runs several images through the model of a DefaultPredictor in one forward pass.
+    Each image is preprocessed the same way DefaultPredictor does it.
+
+    Inputs:
+        - predictor: DefaultPredictor from getSegmentModel or getLIVECell
+        - imgs: List of images in BGR order, as passed to predictor
+    Outputs:
+        - outputs: List of {'instances': Instances} for each image
+    """
+    inputs = []
+    for img in imgs:
+        if predictor.input_format == 'RGB':
+            img = img[:, :, ::-1]
+        height, width = img.shape[:2]
+        image = predictor.aug.get_transform(img).apply_image(img)
+        image = torch.as_tensor(image.astype('float32').transpose(2, 0, 1))
+        inputs.append({'image': image, 'height': height, 'width': width})
+    with torch.no_grad():
+        outputs = predictor.model(inputs)
+    return outputs
+
+def getTileStarts(length: int, tileSize: int, overlap: int):
+    """
+    Gets the start of each tile along one axis so that tiles overlap by at least overlap
+    pixels and the last tile ends at the edge of the image
+    """
+    if length <= tileSize:
+        return [0]
+    stride = tileSize - overlap
+    starts = list(range(0, length - tileSize, stride))
+    starts.append(length - tileSize)
+    return starts
+
+def maskOverlap(maskA, startA, maskB, startB):
+    """
+    Counts the pixels shared by two tile masks placed at (row, column) starts in the frame
+    """
+    rowMin, colMin = max(startA[0], startB[0]), max(startA[1], startB[1])
+    rowMax = min(startA[0] + maskA.shape[0], startB[0] + maskB.shape[0])
+    colMax = min(startA[1] + maskA.shape[1], startB[1] + maskB.shape[1])
+    if rowMax <= rowMin or colMax <= colMin:
+        return 0
+    windowA = maskA[rowMin-startA[0]:rowMax-startA[0], colMin-startA[1]:colMax-startA[1]]
+    windowB = maskB[rowMin-startB[0]:rowMax-startB[0], colMin-startB[1]:colMax-startB[1]]
+    return int(np.sum(windowA & windowB))
+
+def cropMask(mask):
+    """
+    Crops a mask to the pixels it covers
+
+    Inputs:
+        - mask: Boolean mask
+    Outputs:
+        - crop: Mask cropped to its bounding box, None if the mask is empty
+        - start: (row, column) of crop[0, 0] in mask
+    """
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    if len(rows) == 0:
+        return None, (0, 0)
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    return mask[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1].copy(), (int(rows[0]), int(cols[0]))
+
+def pasteMasks(instances):
+    """
+    Builds the N x height x width stack of full frame masks from the cropped masks of tiledPredict.
+    Only needed by code that has no use for mask_crops and mask_offsets.
+    """
+    height, width = instances.image_size
+    masks = torch.zeros((len(instances), height, width), dtype=torch.bool)
+    for n, (crop, (row, col)) in enumerate(zip(instances.mask_crops, instances.mask_offsets.tolist())):
+        masks[n, row:row+crop.shape[0], col:col+crop.shape[1]] = torch.from_numpy(crop)
+    return masks
+
+def tiledPredict(predictor, img, tileSize: int = 512, overlap: int = 128, batchSize: int = 4,
+                 iouThresh: float = 0.5, seamMargin: int = 2):
+    """
+    Segments a whole frame by predicting overlapping tiles and merging instances that were
+    found in more than one tile. Instances that do not touch the edge of their tile inside
+    the frame (a seam) are preferred, so cells cut by one tile are taken whole from another.
+    Masks are kept cropped to the pixels they cover and only instances in the same
+    overlap x overlap grid cells are compared, so memory and time scale with the number
+    of cells rather than the frame size times the number of cells.
+
+    Inputs:
+        - predictor: DefaultPredictor from getSegmentModel or getLIVECell
+        - img: Whole frame in BGR order, as passed to predictor
+        - tileSize: Height and width of each tile
+        - overlap: Minimum overlap between neighboring tiles, should be larger than a cell
+        - batchSize: Number of tiles passed through the model at once
+        - iouThresh: Mask IoU above which two instances are the same cell. Instances touching
+          a seam are also dropped when this fraction of their area is already covered
+        - seamMargin: Distance in pixels from a seam counted as touching it
+    Outputs:
+        - outputs: {'instances': Instances} in whole frame coordinates on the CPU. Instead of
+          pred_masks, each mask is stored as mask_crops (list of boolean arrays) starting at
+          mask_offsets (N x 2 row, column), see pasteMasks
+    """
+    height, width = img.shape[:2]
+    starts = [(row, col) for row in getTileStarts(height, tileSize, overlap) \
+                         for col in getTileStarts(width, tileSize, overlap)]
+
+    masks, boxes, scores, classes, offsets, touchesSeam = [], [], [], [], [], []
+    for batchStart in range(0, len(starts), batchSize):
+        batchStarts = starts[batchStart:batchStart+batchSize]
+        tiles = [img[row:row+tileSize, col:col+tileSize] for row, col in batchStarts]
+        for (row, col), tile, output in zip(batchStarts, tiles, batchPredict(predictor, tiles)):
+            instances = output['instances'].to('cpu')
+            tileHeight, tileWidth = tile.shape[:2]
+            tileBoxes = instances.pred_boxes.tensor.numpy()
+            tileMasks = instances.pred_masks.numpy()
+            # Tile edges that are not the edge of the frame
+            seams = [row > 0, col > 0, row + tileHeight < height, col + tileWidth < width]
+            for n in range(len(instances)):
+                mask, (maskRow, maskCol) = cropMask(tileMasks[n])
+                if mask is None:
+                    continue
+                # Keep a border of background inside the frame so contours close as in the full frame
+                maskRow, maskCol = row + maskRow, col + maskCol
+                padTop, padLeft = min(maskRow, 1), min(maskCol, 1)
+                padBottom = min(height - maskRow - mask.shape[0], 1)
+                padRight = min(width - maskCol - mask.shape[1], 1)
+                mask = np.pad(mask, ((padTop, padBottom), (padLeft, padRight)))
+                x0, y0, x1, y1 = tileBoxes[n]
+                touches = (seams[0] and y0 <= seamMargin) or (seams[1] and x0 <= seamMargin) or \
+                          (seams[2] and y1 >= tileHeight - seamMargin) or (seams[3] and x1 >= tileWidth - seamMargin)
+                masks.append(mask)
+                boxes.append(tileBoxes[n] + np.array([col, row, col, row]))
+                scores.append(float(instances.scores[n]))
+                classes.append(int(instances.pred_classes[n]))
+                offsets.append((maskRow - padTop, maskCol - padLeft))
+                touchesSeam.append(touches)
+
+    # Keep whole, confident instances first, then drop anything duplicating a kept instance
+    order = sorted(range(len(masks)), key = lambda n: (touchesSeam[n], -scores[n]))
+    areas = [int(np.sum(mask)) for mask in masks]
+    # Pixel extent of each mask, [rowMin, rowMax) and [colMin, colMax)
+    extents = [(row, row + mask.shape[0], col, col + mask.shape[1]) for mask, (row, col) in zip(masks, offsets)]
+    grid = {}
+    keep = []
+    for n in order:
+        rowMin, rowMax, colMin, colMax = extents[n]
+        cells = [(gridRow, gridCol) for gridRow in range(rowMin // overlap, (rowMax - 1) // overlap + 1) \
+                                    for gridCol in range(colMin // overlap, (colMax - 1) // overlap + 1)]
+        candidates = set()
+        for cell in cells:
+            candidates.update(grid.get(cell, []))
+        duplicate = False
+        for k in sorted(candidates):
+            # Masks can share at most the pixels where their extents overlap
+            boxIntersection = max(min(rowMax, extents[k][1]) - max(rowMin, extents[k][0]), 0) * \
+                              max(min(colMax, extents[k][3]) - max(colMin, extents[k][2]), 0)
+            bound = min(boxIntersection, areas[n], areas[k])
+            if bound / (areas[n] + areas[k] - bound) <= iouThresh and \
+               (not touchesSeam[n] or bound / areas[n] <= iouThresh):
+                continue
+            intersection = maskOverlap(masks[n], offsets[n], masks[k], offsets[k])
+            iou = intersection / (areas[n] + areas[k] - intersection)
+            if iou > iouThresh or (touchesSeam[n] and intersection / areas[n] > iouThresh):
+                duplicate = True
+                break
+        if not duplicate:
+            for cell in cells:
+                grid.setdefault(cell, []).append(n)
+            keep.append(n)
+
+    instances = Instances((height, width))
+    instances.pred_boxes = Boxes(torch.tensor(np.array([boxes[n] for n in keep]).reshape(-1, 4), dtype=torch.float32))
+    instances.scores = torch.tensor([scores[n] for n in keep], dtype=torch.float32)
+    instances.pred_classes = torch.tensor([classes[n] for n in keep], dtype=torch.int64)
+    instances.mask_crops = [masks[n] for n in keep]
+    instances.mask_offsets = torch.tensor([offsets[n] for n in keep], dtype=torch.int64).reshape(-1, 2)
+    return {'instances': instances}
+
 def getLIVECell(confidenceThresh = 0.3, homePath = '..'):
     cfg = get_cfg()
     cfg.merge_from_file(f'{homePath}/data/sartorius/configs/bt474_config.yaml')
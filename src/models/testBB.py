@@ -1,4 +1,4 @@
-from src.data.imageProcessing import bbIncrease
+from src.data.imageProcessing import bbIncrease, bbIncreaseWindows, cropResizeROIs
 from src.data.fileManagement import splitName2Whole, getModelDetails
 from src.models import trainBB
 
@@ -24,8 +24,62 @@ from torch.optim import lr_scheduler
 import torch.nn as nn
 import torch.optim as optim
 
-def predictDataset(datasetDict, model):
-    pass
+def predictDataset(datasetDicts, model, dataPath, modelInputs, batch_size = 256):
+    """
+    Predicts every cell in a datasetDict. All cells of a whole image are cropped
+    in a single call to cropResizeROIs, so each whole image is read once.
+
+    Inputs:
+        - datasetDicts: Segmentation information in detectron2 format
+        - model: Trained classification model
+        - dataPath: Location of whole images
+        - modelInputs: Model details, must include nIncrease, maxImgSize, and nIms
+        - batch_size: Number of cells passed through the model at once
+    Outputs:
+        - probs: Returned probabilities of class identification from network
+        - scores: softmax of probs
+        - imgNames: Split image name of each cell
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    model.eval()
+    maxImgSize = modelInputs['maxImgSize']
+    mean = torch.tensor(trainBB.imgMean[0], dtype=torch.float32)
+    std = torch.tensor(trainBB.imgStd[0], dtype=torch.float32)
+
+    # Group split images by the whole image they came from
+    wholeRecords = {}
+    for record in datasetDicts:
+        imgName = os.path.basename(record['file_name'])
+        wholeRecords.setdefault(splitName2Whole(imgName), []).append(record)
+
+    probs, scores, imgNames = [], [], []
+    for imgNameWhole, records in tqdm(wholeRecords.items()):
+        bbs, cellImgNames = [], []
+        for record in records:
+            imgName = os.path.basename(record['file_name'])
+            for annotation in record['annotations']:
+                bbs.append([int(corner) for corner in annotation['bbox']])
+                cellImgNames.append(imgName)
+        if len(bbs) == 0:
+            continue
+        img = imread(os.path.join(dataPath, imgNameWhole))
+        windows = bbIncreaseWindows(bbs, cellImgNames, img.shape, modelInputs['nIms'], modelInputs['nIncrease'])
+        crops = cropResizeROIs(img, windows, maxImgSize)
+        # Match the uint8 round trip and normalization of the test transforms
+        crops = torch.tensor(np.uint8(crops*255), dtype=torch.float32)/255
+        crops = ((crops - mean)/std).unsqueeze(1).expand(-1, 3, -1, -1)
+        with torch.no_grad():
+            for batchStart in range(0, crops.shape[0], batch_size):
+                inputs = crops[batchStart:batchStart+batch_size].to(device)
+                outputs = model(inputs)
+                probs.append(outputs.cpu().data.numpy())
+                scores.append(F.softmax(outputs, dim=1).cpu().data.numpy())
+        imgNames += cellImgNames
+
+    probs = np.concatenate(probs)
+    scores = np.concatenate(scores)
+    return [probs, scores, imgNames]
 
 def testModel(model, loaders, mode = 'test', testSummaryPath='') -> list:
     device_str = "cuda"
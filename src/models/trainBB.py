@@ -1,5 +1,6 @@
-from src.data.imageProcessing import bbIncrease, bbIncreaseBlackout
+from src.data.imageProcessing import bbIncrease, bbIncreaseBlackout, letterboxCrop, bbIncreaseWindows, cropResizeROIs
 from src.data.fileManagement import splitName2Whole
+from src.data.cropStore import loadCropStore, loadCropStoreIndex, loadCropPyramid, pyramidCrop
 
 import random
 import numpy as np
@@ -17,7 +18,8 @@ from skimage.draw import polygon2mask
 
 from PIL import Image
 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data import default_collate
 import torch
 import torch.nn.functional as F
 from torchvision import transforms, models
@@ -25,6 +27,75 @@ from torch.optim import lr_scheduler
 import torch.nn as nn
 import torch.optim as optim
 
+# Normalization values for phase contrast crops
+imgMean = np.array([0.4840, 0.4840, 0.4840])
+imgStd = np.array([0.1047, 0.1047, 0.1047])
+
+class imageCache:
+    """
+    Bounded least recently used cache of decoded whole images
+
+    Every DataLoader worker holds its own copy of the dataset, so each worker
+    keeps its own cache. Without workers the main process holds the only one.
+
+    Attributes
+    --------------------
+    - maxBytes: Budget for all cached images in bytes, 0 disables caching
+    - nBytes: Bytes currently held by the cache
+    - images: Ordered dictionary of path -> image, least recently used first
+    - hits: Number of reads served from the cache
+    - misses: Number of reads which had to decode the image
+    """
+    def __init__(self, maxBytes = 2**29):
+        self.maxBytes = maxBytes
+        self.images = OrderedDict()
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, path):
+        """
+        Returns the decoded image at path, reading it only if it is not cached
+
+        Images are returned read-only since they are shared between cells.
+        """
+        if path in self.images:
+            self.images.move_to_end(path)
+            self.hits += 1
+            return self.images[path]
+        self.misses += 1
+        img = imread(path)
+        img.flags.writeable = False
+        self.put(path, img)
+        return img
+
+    def put(self, path, img):
+        """Adds an image and evicts the least recently used ones until under budget"""
+        if img.nbytes > self.maxBytes:
+            return
+        self.images[path] = img
+        self.nBytes += img.nbytes
+        while self.nBytes > self.maxBytes:
+            _, oldImg = self.images.popitem(last=False)
+            self.nBytes -= oldImg.nbytes
+
+    def clear(self):
+        """Empties the cache and resets counters"""
+        self.images = OrderedDict()
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and current size"""
+        nReads = self.hits + self.misses
+        hitRate = self.hits/nReads if nReads > 0 else 0
+        return {'hits': self.hits, 'misses': self.misses, 'hitRate': hitRate,
+                'nImages': len(self.images), 'nBytes': self.nBytes}
+
 class singleCellLoader(Dataset):
     """
     Dataloader class for cropping out a cell from an image
@@ -36,10 +107,17 @@ class singleCellLoader(Dataset):
     - phase: Train/test phase
     - seed: Random seed for shuffling
     - transforms: Transforms for reducing overfitting
-    - segmentations: List of polygons of segmentations from datasetDicts
-    - phenotypes: List of phenotypes associated with each segmentation
-    - imgNames: List of paths to load image
-    - bbs: List of bounding boxes for segmentations
+    - polyCoords, polyOffsets: Flat float32 polygon vertices and the int64 start of each cell's vertices
+    - rleCounts, rleOffsets, rleBoxes: Flat run length counts, the start of each cell's counts, and the offset and size of each run length encoded mask
+    - phenotypes: int16 array of phenotypes associated with each segmentation
+    - imgIdx, imgNameTable: int32 index of each cell into the deduplicated image names
+    - bbs: int32 array of bounding boxes for segmentations
+    - annIdx: Position of each cell among all annotations of datasetDicts
+    - imgCache: Cache of decoded whole images, see imageCache
+    - cropStorePath: Optional crop store made by src.data.cropStore.buildCropStore or buildCropPyramid
+    - batchedCrops: Crop all cells of a batch from the same whole image in one call
+    - tensorTransforms: Return single channel uint8 tensors to be augmented per batch by batchTransforms
+    - resampleEpochs: Keep all training cells so a classBalancedSampler can rebalance every epoch
     """
     def __init__(self, datasetDicts, transforms, dataPath, phase, modelInputs, randomSeed = 1234):
         """
@@ -68,7 +146,13 @@ class singleCellLoader(Dataset):
         else:
             self.testWell = ['B7']
 
-        self.segmentations, self.phenotypes, self.imgNames, self.bbs = self.balance(datasetDicts)
+        # Resampling keeps every training cell and balances each epoch with classBalancedSampler
+        if 'resampleEpochs' in modelInputs.keys():
+            self.resampleEpochs = modelInputs['resampleEpochs']
+        else:
+            self.resampleEpochs = False
+
+        self.setTable(self.balance(datasetDicts))
         self.experiment = modelInputs['experiment']
         self.nIncrease = modelInputs['nIncrease']
 
@@ -95,40 +179,188 @@ class singleCellLoader(Dataset):
             self.maxImgSize = modelInputs['maxImgSize']
             self.nIms = modelInputs['nIms']
 
-        
+        # Each whole image holds many cells, so keep recently decoded images around
+        if 'cacheBytes' in modelInputs.keys():
+            cacheBytes = modelInputs['cacheBytes']
+        else:
+            cacheBytes = 2**29
+        self.imgCache = imageCache(cacheBytes)
+
+        # Crops can be read from a prebuilt crop store instead of being cut from whole images
+        self.cropStore = None
+        if 'cropStore' in modelInputs.keys():
+            self.cropStorePath = modelInputs['cropStore']
+            self.checkCropStore()
+        else:
+            self.cropStorePath = None
+
+        if 'tensorTransforms' in modelInputs.keys():
+            self.tensorTransforms = modelInputs['tensorTransforms']
+        else:
+            self.tensorTransforms = False
+
+        # Batched cropping only supports unaugmented crops
+        if 'batchedCrops' in modelInputs.keys():
+            self.batchedCrops = modelInputs['batchedCrops'] and self.augmentation in ['None', None]
+        else:
+            self.batchedCrops = False
+
     def __len__(self):
-        return len(self.imgNames)
+        return len(self.phenotypes)
+
+    def setTable(self, table):
+        """
+        Stores the columns of an annotation table (see annotationTable) as attributes.
+        Every column is a plain numeric array so that forked DataLoader workers share
+        the pages rather than copying them through reference count updates.
+        """
+        self.polyCoords = table['polyCoords']
+        self.polyOffsets = table['polyOffsets']
+        self.rleCounts = table['rleCounts']
+        self.rleOffsets = table['rleOffsets']
+        self.rleBoxes = table['rleBoxes']
+        self.bbs = table['bbs']
+        self.phenotypes = table['phenotypes']
+        self.imgIdx = table['imgIdx']
+        self.imgNameTable = table['imgNameTable']
+        self.annIdx = table['annIdx']
+
+    @property
+    def imgNames(self):
+        """Image name of every cell"""
+        return self.imgNameTable[self.imgIdx]
+
+    @property
+    def segmentations(self):
+        """Polygon of every cell as an object array of nx2 arrays"""
+        segmentations = np.empty(len(self), dtype='object')
+        for idx in range(len(self)):
+            segmentations[idx] = self.getPolygon(idx)
+        return segmentations
+
+    def getImgName(self, idx):
+        """Returns the image name of a cell"""
+        return str(self.imgNameTable[self.imgIdx[idx]])
+
+    def getPolygon(self, idx):
+        """Returns the nx2 polygon of a cell"""
+        return self.polyCoords[self.polyOffsets[idx]:self.polyOffsets[idx+1]].astype('float64')
+
+    def getRLE(self, idx):
+        """Returns the run length encoded mask of a cell (see mask2rle) or None if it was not saved"""
+        if self.rleOffsets[idx] == self.rleOffsets[idx+1]:
+            return None
+        rowOffset, colOffset, height, width = self.rleBoxes[idx].tolist()
+        rle = {
+            'size': [height, width],
+            'counts': self.rleCounts[self.rleOffsets[idx]:self.rleOffsets[idx+1]],
+            'offset': [rowOffset, colOffset]
+        }
+        return rle
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
         
-        imgName = self.imgNames[idx]
-        imgNameWhole = splitName2Whole(imgName)
-        label = self.phenotypes[idx]
-        fullPath = os.path.join(self.dataPath, imgNameWhole)
-        maxRows, maxCols = self.maxImgSize, self.maxImgSize
-        img = imread(fullPath)
+        label = int(self.phenotypes[idx])
+        if self.cropStorePath is not None:
+            pcCrop = self.getStoredCrop(idx)
+        else:
+            pcCrop = np.uint8(self.getCrop(idx)*255)
+        return self.transformCrop(pcCrop), label
 
-        bb = self.bbs[idx]
-        poly = self.segmentations[idx]
-        nIncrease = self.nIncrease
-        imgCrop = bbIncrease(poly, bb, imgName, img, self.nIms, self.nIncrease, augmentation=self.augmentation)
-        # Pad image
-        diffRows = int((maxRows - imgCrop.shape[0])/2)
-        diffCols = int((maxCols - imgCrop.shape[1])/2)
-        if diffRows < 0:
-            diffRows = 0
-        if diffCols < 0:
-            diffCols = 0
-        pcCrop = F.pad(torch.tensor(imgCrop), pad=(diffCols, diffCols, diffRows, diffRows)).numpy()
-        pcCrop = resize(pcCrop, (maxRows, maxCols))
-
-        pcCrop = np.array([pcCrop, pcCrop, pcCrop]).transpose((1,2,0))
+    def transformCrop(self, pcCrop):
+        """
+        Converts a uint8 crop to the model input. In tensor mode the crop stays a
+        single channel uint8 tensor and is augmented later as part of a batch.
+        """
+        if self.tensorTransforms:
+            return torch.from_numpy(np.ascontiguousarray(pcCrop))
+        img = np.array([pcCrop, pcCrop, pcCrop]).transpose((1,2,0))
         if self.transforms:
-            pcCrop = Image.fromarray(np.uint8(pcCrop*255))
-            img = self.transforms(pcCrop)
-        return img, label
+            img = self.transforms(Image.fromarray(img))
+        return img
+
+    def __getitems__(self, idxs):
+        """
+        Fetches a whole batch. When batchedCrops is set, cells sharing a whole image
+        are cropped together with cropResizeROIs.
+        """
+        if not self.batchedCrops or self.cropStorePath is not None:
+            return [self.__getitem__(idx) for idx in idxs]
+
+        idxs = [int(idx) for idx in idxs]
+        pcCrops = {}
+        imgNamesWhole = [splitName2Whole(self.getImgName(idx)) for idx in idxs]
+        for imgNameWhole in set(imgNamesWhole):
+            frameIdxs = [idx for idx, name in zip(idxs, imgNamesWhole) if name == imgNameWhole]
+            img = self.imgCache.get(os.path.join(self.dataPath, imgNameWhole))
+            windows = bbIncreaseWindows(self.bbs[frameIdxs],
+                                        [self.getImgName(idx) for idx in frameIdxs],
+                                        img.shape, self.nIms, self.nIncrease)
+            crops = cropResizeROIs(img, windows, self.maxImgSize)
+            for idx, crop in zip(frameIdxs, crops):
+                pcCrops[idx] = np.uint8(crop*255)
+
+        samples = [(self.transformCrop(pcCrops[idx]), int(self.phenotypes[idx])) for idx in idxs]
+        return samples
+
+    def getCrop(self, idx):
+        """
+        Crops a cell from its whole image, then pads and resizes it to maxImgSize
+
+        Inputs:
+            - idx: Index of cell
+        Outputs:
+            - pcCrop: maxImgSize x maxImgSize crop scaled between 0 and 1
+        """
+        imgName = self.getImgName(idx)
+        fullPath = os.path.join(self.dataPath, splitName2Whole(imgName))
+        img = self.imgCache.get(fullPath)
+
+        bb = self.bbs[idx]
+        poly = self.getPolygon(idx)
+        imgCrop = bbIncrease(poly, bb, imgName, img, self.nIms, self.nIncrease, augmentation=self.augmentation, rle=self.getRLE(idx))
+        pcCrop = letterboxCrop(imgCrop, self.maxImgSize)
+        return pcCrop
+
+    def getStoredCrop(self, idx):
+        """
+        Reads a uint8 crop from the crop store. Letterboxed stores hold finished crops,
+        crop pyramids are cut down to nIncrease and letterboxed here. The store is opened
+        lazily so that each DataLoader worker maps it on its own.
+        """
+        if self.cropStore is None:
+            if loadCropStoreIndex(self.cropStorePath)['params']['kind'] == 'pyramid':
+                self.cropStore = loadCropPyramid(self.cropStorePath)
+            else:
+                self.cropStore, _ = loadCropStore(self.cropStorePath)
+        if isinstance(self.cropStore, tuple):
+            crops, masks, index = self.cropStore
+            imgCrop = pyramidCrop(crops, masks, index, self.annIdx[idx], self.nIncrease, self.augmentation)
+            return np.uint8(letterboxCrop(imgCrop, self.maxImgSize)*255)
+        return self.cropStore[self.annIdx[idx]]
+
+    def checkCropStore(self):
+        """
+        Verifies that the crop store was built from the same datasetDicts and crop parameters
+        """
+        index = loadCropStoreIndex(self.cropStorePath)
+        params = index['params']
+        if params['kind'] == 'pyramid':
+            if self.nIncrease > params['nIncreaseMax']:
+                raise ValueError(f"Crop pyramid only goes up to nIncrease = {params['nIncreaseMax']}")
+            modelParams = {'nIms': self.nIms}
+        else:
+            modelParams = {'nIncrease': self.nIncrease, 'maxImgSize': self.maxImgSize,
+                           'nIms': self.nIms, 'augmentation': str(self.augmentation)}
+        for param, val in modelParams.items():
+            if params[param] != val:
+                raise ValueError(f'Crop store has {param} = {params[param]} but the model uses {val}')
+        if len(self.annIdx) > 0 and self.annIdx.max() >= len(index['imgNames']):
+            raise ValueError('Crop store has fewer cells than datasetDicts')
+        if not np.array_equal(index['imgNames'][self.annIdx], np.array(self.imgNames, dtype='str')):
+            raise ValueError('Crop store was built from a different datasetDicts')
 
     def plotResults(self, idx):
         img, label = self.__getitem__(idx)
@@ -142,27 +374,11 @@ class singleCellLoader(Dataset):
         Input: 
             - datasetDicts, detectron2 format for segmentations
         Output:
-            - segmentation, numpy array of nx2
-            - phenotypes, list of encoded phenotypes
-            - imgNames, list of image names
+            - table: Annotation table (see annotationTable) of the balanced, shuffled cells
         """
         # Split off well for training/testing
-        testWell = self.testWell
-        if self.phase == 'train':
-            datasetDicts = [seg for seg in datasetDicts if seg['file_name'].split('_')[1] not in testWell]
-        elif self.phase == 'test':
-            datasetDicts = [seg for seg in datasetDicts if seg['file_name'].split('_')[1] in testWell]
-
-        # Reformat dataset dict to most relevant information
-        segmentations, phenotypes, imgNames, bbs = [], [], [], []
-        # Note there is a lot of repeats for images but this is much cleaner
-        for img in datasetDicts:
-            imgName = os.path.basename(img['file_name'])
-            for annotation in img['annotations']:
-                segmentations.append(np.array(annotation['segmentation'][0]))
-                phenotypes.append(annotation['category_id'])
-                imgNames.append(imgName)
-                bbs.append([int(corner) for corner in annotation['bbox']])
+        table = annotationTable(datasetDicts, self.phase, self.testWell)
+        phenotypes = table['phenotypes']
         # Balance dataset
         uniquePheno, cts = np.unique(phenotypes, return_counts=True)
         
@@ -175,10 +391,15 @@ class singleCellLoader(Dataset):
         if maxAmt > min(cts):
             self.maxAmt = min(cts)
 
-        segmentations, phenotypes, imgNames, bbs = self.shuffleLists([segmentations, phenotypes, imgNames, bbs], self.seed)
+        # Shuffling indices gives the same permutation as shuffling the lists themselves
+        order = list(range(len(phenotypes)))
+        random.seed(self.seed)
+        random.shuffle(order)
+        order = np.array(order, dtype='int64')
+        phenotypes = phenotypes[order]
         uniqueIdx = []
 
-        if self.phase == 'train':
+        if self.phase == 'train' and not self.resampleEpochs:
             for pheno in uniquePheno:
                 
                 idx = list(np.where(phenotypes == pheno)[0][0:self.maxAmt])
@@ -190,19 +411,354 @@ class singleCellLoader(Dataset):
         
         self.uniqueIdx = uniqueIdx
         # Get finalized amts
-        segmentations = np.array([np.reshape(seg, (int(len(seg)/2), 2)) for seg in segmentations[uniqueIdx]], dtype='object')
-        phenotypes = phenotypes[uniqueIdx]
-        imgNames = imgNames[uniqueIdx]
-        bbs = bbs[uniqueIdx]
-        return [segmentations, phenotypes, imgNames, bbs]
-    
+        return takeAnnotations(table, order[uniqueIdx])
+
+def annotationTable(datasetDicts, phase = 'none', testWell = []):
+    """
+    Flattens the annotations of datasetDicts into a struct-of-arrays table
+
+    Inputs:
+        - datasetDicts: Segmentations in detectron2 format
+        - phase: 'train' drops testWell, 'test' only keeps testWell, anything else keeps all wells
+        - testWell: List of wells held out for testing
+    Outputs:
+        - table: Dictionary of
+            - polyCoords: float32 Px2 (x, y) polygon vertices of every annotation
+            - polyOffsets: int64 N+1 start of each annotation's vertices in polyCoords
+            - rleCounts: int32 run length counts of every annotation['maskRLE']
+            - rleOffsets: int64 N+1 start of each annotation's counts, empty if it has no maskRLE
+            - rleBoxes: int32 Nx4 row offset, column offset, height, and width of each maskRLE
+            - bbs: int32 Nx4 bounding boxes
+            - phenotypes: int16 encoded phenotypes
+            - imgIdx: int32 index into imgNameTable
+            - imgNameTable: Deduplicated image names
+            - annIdx: int64 position of the annotation among all annotations of datasetDicts
+    """
+    polys, polyLengths, bbs, phenotypes, imgIdx, annIdx = [], [], [], [], [], []
+    rles, rleLengths, rleBoxes = [], [], []
+    imgNameTable = []
+    nAnnotations = 0
+    for record in datasetDicts:
+        nRecord = len(record['annotations'])
+        well = record['file_name'].split('_')[1]
+        if (phase == 'train' and well in testWell) or (phase == 'test' and well not in testWell):
+            nAnnotations += nRecord
+            continue
+        imgNameTable.append(os.path.basename(record['file_name']))
+        for annotation in record['annotations']:
+            seg = np.asarray(annotation['segmentation'][0], dtype='float32')
+            nPts = int(len(seg)/2)
+            polys.append(seg[0:2*nPts])
+            polyLengths.append(nPts)
+            bbs.append([int(corner) for corner in annotation['bbox']])
+            rle = annotation.get('maskRLE', None)
+            if rle is None:
+                rleLengths.append(0)
+                rleBoxes.append([0, 0, 0, 0])
+            else:
+                rles.append(np.asarray(rle['counts'], dtype='int32'))
+                rleLengths.append(len(rle['counts']))
+                rleBoxes.append(list(rle['offset']) + list(rle['size']))
+            phenotypes.append(annotation['category_id'])
+            imgIdx.append(len(imgNameTable) - 1)
+            annIdx.append(nAnnotations)
+            nAnnotations += 1
+
+    polyOffsets = np.zeros(len(polyLengths) + 1, dtype='int64')
+    polyOffsets[1:] = np.cumsum(polyLengths)
+    if len(polys) > 0:
+        polyCoords = np.concatenate(polys).reshape(-1, 2)
+    else:
+        polyCoords = np.zeros((0, 2), dtype='float32')
+    rleOffsets = np.zeros(len(rleLengths) + 1, dtype='int64')
+    rleOffsets[1:] = np.cumsum(rleLengths)
+    table = {
+        'polyCoords': polyCoords,
+        'polyOffsets': polyOffsets,
+        'rleCounts': np.concatenate(rles) if len(rles) > 0 else np.zeros(0, dtype='int32'),
+        'rleOffsets': rleOffsets,
+        'rleBoxes': np.array(rleBoxes, dtype='int32').reshape(-1, 4),
+        'bbs': np.array(bbs, dtype='int32').reshape(-1, 4),
+        'phenotypes': np.array(phenotypes, dtype='int16'),
+        'imgIdx': np.array(imgIdx, dtype='int32'),
+        'imgNameTable': np.array(imgNameTable, dtype='str'),
+        'annIdx': np.array(annIdx, dtype='int64'),
+    }
+    return table
+
+def takeAnnotations(table, idx):
+    """
+    Selects rows of an annotation table
+
+    Inputs:
+        - table: Annotation table from annotationTable
+        - idx: Rows to keep, in order
+    Outputs:
+        - tableNew: Annotation table with only the selected rows
+    """
+    idx = np.asarray(idx, dtype='int64')
+    tableNew = {'imgNameTable': table['imgNameTable']}
+    for values, offsets in [('polyCoords', 'polyOffsets'), ('rleCounts', 'rleOffsets')]:
+        lengths = np.diff(table[offsets])[idx]
+        offsetsNew = np.zeros(len(idx) + 1, dtype='int64')
+        offsetsNew[1:] = np.cumsum(lengths)
+        # Gather the ragged rows with one index array
+        valueIdx = np.repeat(table[offsets][idx] - offsetsNew[:-1], lengths) + np.arange(offsetsNew[-1])
+        tableNew[values] = table[values][valueIdx]
+        tableNew[offsets] = offsetsNew
+    for column in ['bbs', 'rleBoxes', 'phenotypes', 'imgIdx', 'annIdx']:
+        tableNew[column] = table[column][idx]
+    return tableNew
+
+class imageGroupedBatchSampler(Sampler):
+    """
+    Batch sampler which shuffles whole images instead of single cells
+
+    Cells are grouped by the whole image they are cropped from. Every epoch the
+    whole images are shuffled, then batches are drawn from a window of nFrames
+    whole images at a time so that neighboring batches reuse the same decoded
+    images. Only the cells kept by singleCellLoader.balance are sampled, so the
+    class balance is unchanged. If a sampler is given (e.g. classBalancedSampler),
+    the cells it draws each epoch are grouped instead.
+
+    Attributes
+    --------------------
+    - frameIds: Index of the whole image of each cell
+    - sampler: Optional sampler choosing which cells are used each epoch
+    - batch_size: Number of cells per batch
+    - nFrames: Number of whole images shuffled together into a window
+    - seed: Random seed, offset by the epoch so each epoch is reproducible
+    - epoch: Number of times the sampler has been iterated
+    - drop_last: Drops the last incomplete batch
+    """
+    def __init__(self, dataset, batch_size, nFrames = 4, seed = 1234, drop_last = False, sampler = None):
+        self.batch_size = batch_size
+        self.nFrames = max(int(nFrames), 1)
+        self.seed = seed
+        self.epoch = 0
+        self.drop_last = drop_last
+        self.sampler = sampler
+        self.nCells = len(dataset)
+        self.frameIds = self.frameIndex(dataset.imgNames)
+
     @staticmethod
-    def shuffleLists(l, seed=1234):
-        random.seed(seed)
-        l = list(zip(*l))
-        random.shuffle(l)
+    def frameIndex(imgNames):
+        """
+        Finds the whole image of each cell
+
+        Inputs:
+            - imgNames: Split image name for each cell
+        Outputs:
+            - frameIds: Index of each cell's whole image among the sorted whole image names
+        """
+        imgNamesWhole = np.array([splitName2Whole(imgName) for imgName in imgNames])
+        _, frameIds = np.unique(imgNamesWhole, return_inverse=True)
+        return frameIds.reshape(-1)
+
+    def groupCells(self, indices):
+        """
+        Groups cell indices by their whole image
+
+        Inputs:
+            - indices: Cells to group
+        Outputs:
+            - groups: List of index arrays, one for each whole image
+        """
+        frames = self.frameIds[indices]
+        order = np.argsort(frames, kind='stable')
+        splits = np.flatnonzero(np.diff(frames[order])) + 1
+        return np.split(indices[order], splits)
+
+    def __iter__(self):
+        if self.sampler is None:
+            indices = np.arange(self.nCells)
+        else:
+            indices = np.fromiter(iter(self.sampler), dtype='int64')
+        groups = self.groupCells(indices)
+
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+
+        frameOrder = list(range(len(groups)))
+        rng.shuffle(frameOrder)
+        batch = []
+        for windowStart in range(0, len(frameOrder), self.nFrames):
+            window = [int(idx) for frame in frameOrder[windowStart:windowStart+self.nFrames]
+                                for idx in groups[frame]]
+            rng.shuffle(window)
+            for idx in window:
+                batch.append(idx)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if len(batch) > 0 and not self.drop_last:
+            yield batch
+
+    def __len__(self):
+        nCells = self.nCells if self.sampler is None else len(self.sampler)
+        if self.drop_last:
+            return nCells // self.batch_size
+        return (nCells + self.batch_size - 1) // self.batch_size
+
+class classBalancedSampler(Sampler):
+    """
+    Draws a fresh class-balanced subset of cells every epoch from the full annotation table,
+    so every cell can be seen over training without rebuilding the dataset.
+
+    Attributes
+    --------------------
+    - members: Cell indices of each class
+    - nPerClass: Number of cells drawn from each class per epoch
+    - seed: Random seed, offset by the epoch so each epoch is reproducible
+    - epoch: Number of times the sampler has been iterated
+    """
+    def __init__(self, labels, maxAmt = 0, seed = 1234):
+        labels = np.asarray(labels)
+        _, inverse, cts = np.unique(labels, return_inverse=True, return_counts=True)
+        order = np.argsort(inverse.reshape(-1), kind='stable')
+        self.members = np.split(order, np.cumsum(cts)[:-1])
+        if maxAmt == 0 or maxAmt > min(cts):
+            self.nPerClass = int(min(cts))
+        else:
+            self.nPerClass = int(maxAmt)
+        self.seed = seed
+        self.epoch = 0
+
+    def drawEpoch(self):
+        """
+        Returns shuffled cell indices with nPerClass cells of every class
+        """
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        chosen = np.concatenate([members[rng.choice(len(members), self.nPerClass, replace=False)]
+                                 for members in self.members])
+        rng.shuffle(chosen)
+        return chosen
+
+    def __iter__(self):
+        return iter(self.drawEpoch().tolist())
+
+    def __len__(self):
+        return self.nPerClass*len(self.members)
 
-        return [np.array(itm, dtype='object') for itm in list(zip(*l))]
+class batchTransforms:
+    """
+    Collates single channel uint8 crops and augments the whole batch at once as tensors.
+    This is the tensor equivalent of the PIL transforms in makeImageDatasets:
+    random vertical and horizontal flips, a random rotation, scaling to [0, 1],
+    normalization, then expansion to 3 channels.
+
+    Attributes
+    --------------------
+    - augment: Randomly flip and rotate the batch
+    - normalize: Normalize with mean and std
+    - mean, std: Normalization values
+    - degrees: Range of rotation angles in degrees
+    """
+    def __init__(self, augment = True, normalize = True, mean = imgMean[0], std = imgStd[0], degrees = (0, 180)):
+        self.augment = augment
+        self.normalize = normalize
+        self.mean = float(mean)
+        self.std = float(std)
+        self.degrees = degrees
+
+    def __call__(self, samples):
+        imgs, labels = default_collate(samples)
+        return self.transform(imgs), labels
+
+    def transform(self, imgs):
+        """
+        Inputs:
+            - imgs: B x rows x cols uint8 tensor
+        Outputs:
+            - imgs: B x 3 x rows x cols float tensor
+        """
+        imgs = imgs.unsqueeze(1).float()/255
+        if self.augment:
+            nImgs = imgs.shape[0]
+            flipV = (torch.rand(nImgs) < 0.5)[:, None, None, None]
+            imgs = torch.where(flipV, imgs.flip(2), imgs)
+            flipH = (torch.rand(nImgs) < 0.5)[:, None, None, None]
+            imgs = torch.where(flipH, imgs.flip(3), imgs)
+
+            # Counter-clockwise rotation about the center, filling with zeros like RandomRotation
+            angles = torch.empty(nImgs).uniform_(self.degrees[0], self.degrees[1])*np.pi/180
+            cos, sin = torch.cos(angles), torch.sin(angles)
+            zeros = torch.zeros(nImgs)
+            theta = torch.stack([torch.stack([cos, -sin, zeros], dim=1),
+                                 torch.stack([sin, cos, zeros], dim=1)], dim=1)
+            grid = F.affine_grid(theta, list(imgs.shape), align_corners=False)
+            imgs = F.grid_sample(imgs, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+        if self.normalize:
+            imgs = (imgs - self.mean)/self.std
+        return imgs.expand(-1, 3, -1, -1)
+
+def getLoaderSettings(modelInputs):
+    """
+    Resolves DataLoader parallelism settings from modelInputs. If num_workers is 'auto',
+    settings are sized from the available cores. The resolved values are written back
+    into modelInputs so that calling this before modelTools.printModelVariables records
+    them in the model details.
+
+    Inputs:
+        - modelInputs: Model details, optionally with num_workers, prefetch_factor,
+        persistent_workers, and pin_memory
+    Outputs:
+        - loaderSettings: Keyword arguments for DataLoader
+    """
+    def asBool(val):
+        # Values read back from model details are strings
+        if isinstance(val, str):
+            return val == 'True'
+        return bool(val)
+
+    if 'num_workers' in modelInputs.keys():
+        num_workers = modelInputs['num_workers']
+    else:
+        num_workers = 0
+
+    if num_workers == 'auto':
+        if hasattr(os, 'sched_getaffinity'):
+            nCores = len(os.sched_getaffinity(0))
+        else:
+            nCores = os.cpu_count()
+        # Leave one core for the training loop
+        num_workers = min(max(nCores - 1, 0), 16)
+        prefetch_factor = 4
+        persistent_workers = True
+        pin_memory = torch.cuda.is_available()
+    else:
+        num_workers = int(num_workers)
+        prefetch_factor = int(modelInputs['prefetch_factor']) if 'prefetch_factor' in modelInputs.keys() else 2
+        persistent_workers = asBool(modelInputs['persistent_workers']) if 'persistent_workers' in modelInputs.keys() else False
+        pin_memory = asBool(modelInputs['pin_memory']) if 'pin_memory' in modelInputs.keys() else False
+
+    loaderSettings = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    # These are only valid when loading with workers
+    if num_workers > 0:
+        loaderSettings['prefetch_factor'] = prefetch_factor
+        loaderSettings['persistent_workers'] = persistent_workers
+        loaderSettings['worker_init_fn'] = seedWorker
+
+    modelInputs['num_workers'] = num_workers
+    modelInputs['prefetch_factor'] = prefetch_factor if num_workers > 0 else 0
+    modelInputs['persistent_workers'] = persistent_workers and num_workers > 0
+    modelInputs['pin_memory'] = pin_memory
+    return loaderSettings
+
+def seedWorker(workerId):
+    """
+    Initializes a DataLoader worker. Python and numpy are seeded from the worker's torch
+    seed, and the worker starts with its own empty image cache and crop store mapping.
+    """
+    workerSeed = torch.initial_seed() % 2**32
+    np.random.seed(workerSeed)
+    random.seed(workerSeed)
+
+    dataset = torch.utils.data.get_worker_info().dataset
+    if isinstance(dataset, singleCellLoader):
+        dataset.imgCache.clear()
+        dataset.cropStore = None
 
 def makeImageDatasets(datasetDicts, dataPath, modelInputs, data_transforms = [], phase = ['train', 'test'], isShuffle=True):
     """
@@ -212,11 +768,34 @@ def makeImageDatasets(datasetDicts, dataPath, modelInputs, data_transforms = [],
     - datasetDicts: Segmentation information
     - dataPath: Location of images
     - modelInputs: 
+        - groupFrames: If > 0, shuffled batches are drawn from windows of this many
+        whole images using imageGroupedBatchSampler
+        - cropStore: Optional crop store directory, see src.data.cropStore
+        - batchedCrops: Crop cells of a batch that share a whole image together
+        - tensorTransforms: Augment whole batches as tensors with batchTransforms instead of PIL
+        - resampleEpochs: Draw a new class-balanced subset of training cells every epoch
+        - num_workers, prefetch_factor, persistent_workers, pin_memory: DataLoader settings,
+        num_workers may be 'auto', see getLoaderSettings
     """
     batch_size   = modelInputs['batch_size']
+    if 'groupFrames' in modelInputs.keys():
+        groupFrames = modelInputs['groupFrames']
+    else:
+        groupFrames = 0
+    if 'tensorTransforms' in modelInputs.keys():
+        tensorTransforms = modelInputs['tensorTransforms']
+    else:
+        tensorTransforms = False
+    if 'resampleEpochs' in modelInputs.keys():
+        resampleEpochs = modelInputs['resampleEpochs']
+    else:
+        resampleEpochs = False
+    isCustomTransform = data_transforms != []
+    loaderSettings = getLoaderSettings(modelInputs)
+    print(f"Loading with {loaderSettings['num_workers']} workers, pin_memory = {loaderSettings['pin_memory']}")
 
-    mean = np.array([0.4840, 0.4840, 0.4840])
-    std = np.array([0.1047, 0.1047, 0.1047])
+    mean = imgMean
+    std = imgStd
     if data_transforms == []:
         data_transforms = {
             'train': transforms.Compose([
@@ -247,8 +826,25 @@ def makeImageDatasets(datasetDicts, dataPath, modelInputs, data_transforms = [],
     image_datasets = {x: singleCellLoader(datasetDicts, data_transforms[x], dataPath, phase=x, modelInputs = modelInputs) 
                     for x in phase}
     dataset_sizes = {x: len(image_datasets[x]) for x in phase}
-    dataloaders = {x: DataLoader(image_datasets[x], batch_size=batch_size, shuffle=isShuffle)
-                        for x in phase}
+
+    loaderArgs = {x: loaderSettings.copy() for x in phase}
+    for x in phase:
+        sampler = None
+        if x == 'train' and resampleEpochs:
+            sampler = classBalancedSampler(image_datasets[x].phenotypes, modelInputs['maxAmt'], seed=image_datasets[x].seed)
+            dataset_sizes[x] = len(sampler)
+        if isShuffle and groupFrames > 0:
+            loaderArgs[x]['batch_sampler'] = imageGroupedBatchSampler(image_datasets[x], batch_size, groupFrames, seed=image_datasets[x].seed, sampler=sampler)
+        elif sampler is not None:
+            loaderArgs[x]['batch_size'] = batch_size
+            loaderArgs[x]['sampler'] = sampler
+        else:
+            loaderArgs[x]['batch_size'] = batch_size
+            loaderArgs[x]['shuffle'] = isShuffle
+        if tensorTransforms:
+            isAugmented = x != 'test' and not isCustomTransform
+            loaderArgs[x]['collate_fn'] = batchTransforms(augment=isAugmented, normalize=not isCustomTransform)
+    dataloaders = {x: DataLoader(image_datasets[x], **loaderArgs[x]) for x in phase}
     
     if len(phase) == 1:
         dataloaders = dataloaders[phase[0]]
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+@pytest.fixture(scope='session')
+def segmentModelPath(tmp_path_factory):
+    """
+    Randomly initialized Mask R-CNN saved like a trained model, see modelTools.getSegmentModel.
+    Classifier weights are spread out so scores are far from each other and from the threshold.
+    """
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('detectron2')
+    from detectron2.modeling import build_model
+    from detectron2.checkpoint import DetectionCheckpointer
+    from src.models.modelTools import getSegmentConfig
+
+    modelPath = tmp_path_factory.mktemp('models') / 'segmentation' / 'randomInit'
+    modelPath.mkdir(parents=True)
+    torch.manual_seed(1234)
+    cfg = getSegmentConfig(str(modelPath))
+    cfg.MODEL.DEVICE = 'cpu'
+    model = build_model(cfg)
+    torch.nn.init.normal_(model.roi_heads.box_predictor.cls_score.weight, std=1.0)
+    DetectionCheckpointer(model, save_dir=str(modelPath)).save('model_final')
+    return str(modelPath)
+
+@pytest.fixture(scope='session')
+def phaseContrastImgs():
+    """Small three channel images of bright blobs on a noisy background"""
+    from skimage.draw import disk
+    rng = np.random.default_rng(1234)
+    imgs = []
+    for n in range(2):
+        img = rng.integers(90, 130, (128, 128)).astype('uint8')
+        for cell in range(6):
+            rr, cc = disk(rng.integers(10, 118, 2), rng.integers(5, 12), shape=img.shape)
+            img[rr, cc] = rng.integers(160, 220)
+        imgs.append(np.array([img, img, img]).transpose([1, 2, 0]))
+    return imgs
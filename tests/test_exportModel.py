@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip('detectron2')
+from src.models import modelTools
+from src.models.exportModel import exportSegmentModel, exportedPredictor, checkExportParity
+
+@pytest.mark.parametrize('exportFormat', ['torchscript', 'onnx'])
+def test_exportParity(segmentModelPath, phaseContrastImgs, exportFormat):
+    if exportFormat == 'onnx':
+        pytest.importorskip('onnxruntime')
+    exportSegmentModel(segmentModelPath, phaseContrastImgs[0], exportFormat, confidenceThresh = 0.5)
+    predictor = modelTools.getSegmentModel(segmentModelPath, confidenceThresh = 0.5)
+    exported = exportedPredictor(segmentModelPath)
+    assert exported.exportInfo['format'] == exportFormat
+    assert checkExportParity(predictor, exported, phaseContrastImgs)
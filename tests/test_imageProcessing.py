@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+from skimage.segmentation import clear_border
+
+from src.data.imageProcessing import mask2rle, rle2mask, rleTouchesBorder, interpolatePerimeters, preprocess
+
+imgShape = (20, 30)
+
+def touchesBorderFull(mask):
+    """Full frame check used by notebooks/removeBorderCells.py"""
+    return not np.any(clear_border(ndi.binary_dilation(mask)))
+
+def test_rleRoundTrip():
+    mask = np.zeros(imgShape, dtype='bool')
+    mask[3:7, 10:12] = True
+    mask[5, 13] = True
+    rle = mask2rle(mask)
+    rowOffset, colOffset = rle['offset']
+    localMask = rle2mask(rle)
+    decoded = np.zeros(imgShape, dtype='bool')
+    decoded[rowOffset:rowOffset+localMask.shape[0], colOffset:colOffset+localMask.shape[1]] = localMask
+    assert np.array_equal(decoded, mask)
+
+@pytest.mark.parametrize('distance', [0, 1, 2, 3])
+@pytest.mark.parametrize('side', ['top', 'bottom', 'left', 'right'])
+def test_rleTouchesBorderNearEdge(side, distance):
+    mask = np.zeros(imgShape, dtype='bool')
+    if side == 'top':
+        mask[distance:distance+3, 10:14] = True
+    elif side == 'bottom':
+        mask[imgShape[0]-distance-3:imgShape[0]-distance, 10:14] = True
+    elif side == 'left':
+        mask[8:12, distance:distance+3] = True
+    else:
+        mask[8:12, imgShape[1]-distance-3:imgShape[1]-distance] = True
+    assert rleTouchesBorder(mask2rle(mask), imgShape) == touchesBorderFull(mask)
+    assert rleTouchesBorder(mask2rle(mask), imgShape) == (distance <= 1)
+
+def test_rleTouchesBorderRandom():
+    rng = np.random.default_rng(1234)
+    for _ in range(500):
+        mask = np.zeros(imgShape, dtype='bool')
+        height, width = rng.integers(1, 8, 2)
+        row, col = rng.integers(0, imgShape[0]-height+1), rng.integers(0, imgShape[1]-width+1)
+        mask[row:row+height, col:col+width] = rng.random((height, width)) < 0.6
+        if not mask.any():
+            continue
+        assert rleTouchesBorder(mask2rle(mask), imgShape) == touchesBorderFull(mask)
+
+@pytest.mark.parametrize('kind', ['linear', 'catmullRom'])
+def test_interpolatePerimetersDegenerate(kind):
+    contours = [np.array([[0, 0], [4, 0], [4, 4], [0, 0]], dtype='float'),
+                np.array([[7, 7]], dtype='float'),
+                np.array([[3, 3], [3, 3]], dtype='float'),
+                np.array([[10, 0], [10, 10], [0, 10]], dtype='float')]
+    offsets = np.concatenate(([0], np.cumsum([len(contour) for contour in contours])))
+    perimsInt = interpolatePerimeters(np.concatenate(contours), offsets, nPts = 20, kind = kind)
+    assert perimsInt.shape == (4, 20, 2)
+    assert np.all(perimsInt[1] == [7, 7])
+    assert np.all(perimsInt[2] == [3, 3])
+    assert np.array_equal(perimsInt[0, 0], [0, 0])
+
+def test_preprocessCacheNeedsKey():
+    image = np.full((40, 40), 100, dtype='uint8')
+    with pytest.raises(ValueError):
+        preprocess(image, backgroundCache={})
+    backgroundCache = {}
+    preprocess(image, backgroundCache=backgroundCache, cacheKey='B2_1')
+    assert list(backgroundCache.keys()) == ['B2_1']
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('detectron2')
+from src.models import modelTools
+from src.models.modelTools import getTileStarts
+
+def test_getTileStarts():
+    assert getTileStarts(100, 128, 32) == [0]
+    starts = getTileStarts(1000, 256, 64)
+    assert starts[0] == 0 and starts[-1] == 1000 - 256
+    assert np.all(np.diff(starts) <= 256 - 64)
+
+def test_batchPredictMatchesPredictor(segmentModelPath, phaseContrastImgs):
+    import torch
+    predictor = modelTools.getSegmentModel(segmentModelPath, confidenceThresh = 0.5)
+    outputs = modelTools.batchPredict(predictor, phaseContrastImgs)
+    for img, output in zip(phaseContrastImgs, outputs):
+        expected = predictor(img)['instances'].to('cpu')
+        actual = output['instances'].to('cpu')
+        assert len(actual) == len(expected)
+        torch.testing.assert_close(actual.pred_boxes.tensor, expected.pred_boxes.tensor, atol = 1e-3, rtol = 0)
+        torch.testing.assert_close(actual.scores, expected.scores, atol = 1e-4, rtol = 0)
@@ -0,0 +1,14 @@
+import numpy as np
+
+from src.features.textureFeatures import loadFamily, saveFamily
+
+def test_saveFamilyAppendsChunks(tmp_path):
+    labels = ['Mean', 'Variance']
+    assert len(loadFamily(tmp_path, 'A_FOS')[0]) == 0
+    saveFamily(tmp_path, 'A_FOS', np.array([3, 1]), np.array([0, 2]), np.array([[1., 2.], [3., 4.]]), labels)
+    saveFamily(tmp_path, 'A_FOS', np.array([1]), np.array([0]), np.array([[5., np.nan]]), labels)
+    imageIds, annIdxs, features, loadedLabels = loadFamily(tmp_path, 'A_FOS')
+    assert imageIds.tolist() == [1, 1, 3]
+    assert annIdxs.tolist() == [0, 2, 0]
+    assert np.array_equal(features, [[5., np.nan], [3., 4.], [1., 2.]], equal_nan=True)
+    assert loadedLabels == labels